@@ -0,0 +1,97 @@
+import argparse
+import json
+import random
+import time
+from pathlib import Path
+
+import json_backend
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# ========== 配置 ==========
+DATA_DIRS = [Path("www/data_bak"), Path("www/data")]
+REPEAT = 5  # 每项取多次运行的最短时间
+SYNTH_EVENTS = 2000  # 没有找到地图文件时，合成地图的事件数
+
+
+def find_largest_map() -> Path:
+    candidates = [p for d in DATA_DIRS if d.exists() for p in d.glob("Map*.json")]
+    return max(candidates, key=lambda p: p.stat().st_size) if candidates else None
+
+
+def synth_map(events: int = SYNTH_EVENTS) -> bytes:
+    """合成一个与 RPG Maker 地图结构相近的大文件（紧凑格式）"""
+    rng = random.Random(0)
+    lines = ["村人", "こんにちは！", "いい天気ですね。", "\\C[2]勇者\\C[0]：行くぞ！", "はい", "いいえ"]
+    event_list = [None]
+    for i in range(1, events + 1):
+        commands = [{"code": 101, "indent": 0, "parameters": ["Actor1", 0, 0, 2]}]
+        commands += [{"code": 401, "indent": 0, "parameters": [rng.choice(lines)]} for _ in range(rng.randint(2, 12))]
+        commands.append({"code": 0, "indent": 0, "parameters": []})
+        event_list.append({"id": i, "name": f"EV{i:03d}", "x": rng.randint(0, 99), "y": rng.randint(0, 99),
+                           "pages": [{"image": {"characterName": "People1", "direction": 2},
+                                      "list": commands, "moveSpeed": 3}]})
+    data = {"displayName": "始まりの村", "width": 100, "height": 100,
+            "data": [rng.randint(0, 8000) for _ in range(100 * 100 * 6)], "events": event_list}
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def best_time(func, repeat: int = REPEAT) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="比较 JSON 后端在大地图文件上的读取、写出耗时与输出体积")
+    parser.add_argument("map_file", nargs="?", type=Path, help="地图文件路径（默认取 www/data_bak 或 www/data 中最大的 Map*.json）")
+    args = parser.parse_args()
+
+    map_file = args.map_file or find_largest_map()
+    if map_file is not None:
+        raw = map_file.read_bytes()
+        print(f"测试文件: {map_file} ({len(raw) / 1024:.1f} KB)")
+    else:
+        raw = synth_map()
+        print(f"未找到地图文件，使用合成地图 ({len(raw) / 1024:.1f} KB, {SYNTH_EVENTS} 个事件)")
+
+    style = json_backend.detect_style(raw)
+    data = json.loads(raw.decode("utf-8"))
+    print(f"原文件格式: {style}\n")
+
+    cases = [
+        ("json 读取", lambda: json.loads(raw.decode("utf-8"))),
+        ("json 写出 indent=2", lambda: json.dumps(data, ensure_ascii=False, indent=2).encode("utf-8")),
+        ("json 写出 compact", lambda: json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")),
+    ]
+    if orjson is not None:
+        cases += [
+            ("orjson 读取", lambda: orjson.loads(raw)),
+            ("orjson 写出 indent=2", lambda: orjson.dumps(data, option=orjson.OPT_INDENT_2)),
+            ("orjson 写出 compact", lambda: orjson.dumps(data)),
+        ]
+    else:
+        print("未安装 orjson，仅测试标准库 (pip install orjson)\n")
+
+    print(f"{'项目':<24}{'耗时(ms)':>12}{'输出大小(KB)':>16}")
+    for name, func in cases:
+        elapsed = best_time(func)
+        result = func()
+        size = f"{len(result) / 1024:.1f}" if isinstance(result, bytes) else "-"
+        print(f"{name:<24}{elapsed * 1000:>12.1f}{size:>16}")
+
+    preserved = json_backend.dumps(data, style)
+    indented = json_backend.dumps(data, "indent")
+    print(f"\n当前后端: {json_backend.BACKEND}")
+    print(f"沿用原格式输出: {len(preserved) / 1024:.1f} KB（与原文件{'一致' if preserved == raw else '内容相同、空白不同'}），"
+          f"indent=2 输出: {len(indented) / 1024:.1f} KB，体积为原格式的 {len(indented) / len(preserved):.2f} 倍")
+
+
+if __name__ == "__main__":
+    main()
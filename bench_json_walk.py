@@ -0,0 +1,116 @@
+import argparse
+import copy
+import re
+import sys
+from pathlib import Path
+
+import json_backend
+from bench_json_backend import best_time, find_largest_map, synth_map
+from json_walk import iter_string_slots, iter_strings
+
+# ========== 配置 ==========
+JP_REGEX = re.compile(r'[\u3040-\u30ff\u4e00-\u9fff]+')
+DEEP_NESTING = 5000  # 测试递归深度时的嵌套层数
+
+
+# ========== 旧版递归实现（作为对照） ==========
+def recursive_extract(obj, out: list, path: tuple = ()):
+    """旧版 transfile2json.translate_japanese_in_obj：重建整个结构，每层复制路径"""
+    if isinstance(obj, dict):
+        return {k: recursive_extract(v, out, path + (k,)) for k, v in obj.items()}
+    elif isinstance(obj, list):
+        return [recursive_extract(item, out, path + (i,)) for i, item in enumerate(obj)]
+    elif isinstance(obj, str):
+        if JP_REGEX.search(obj):
+            out.append((path, obj))
+        return obj
+    else:
+        return obj
+
+
+def recursive_write_back(obj, translations, idx_ptr, key_path=None):
+    """旧版 write_back_cn_trans.write_back_translations：重建整个结构，每层复制键路径"""
+    if key_path is None:
+        key_path = []
+    if isinstance(obj, dict):
+        return {k: recursive_write_back(v, translations, idx_ptr, key_path + [k]) for k, v in obj.items()}
+    elif isinstance(obj, list):
+        return [recursive_write_back(item, translations, idx_ptr, key_path) for item in obj]
+    elif isinstance(obj, str):
+        if JP_REGEX.search(obj):
+            if "image" in key_path:
+                idx_ptr[0] += 1
+                return obj
+            translated = translations[idx_ptr[0]]
+            idx_ptr[0] += 1
+            return translated
+        return obj
+    else:
+        return obj
+
+
+# ========== 显式栈实现 ==========
+def iterative_extract(obj, out: list):
+    out.extend(iter_strings(obj, JP_REGEX.search))
+
+
+def iterative_write_back(obj, translations, idx_ptr):
+    for parent, key, key_path, _ in iter_string_slots(obj, JP_REGEX.search):
+        if "image" not in key_path:
+            parent[key] = translations[idx_ptr[0]]
+        idx_ptr[0] += 1
+    return obj
+
+
+def main():
+    parser = argparse.ArgumentParser(description="比较递归遍历与显式栈遍历的提取、写回耗时")
+    parser.add_argument("map_file", nargs="?", type=Path, help="地图文件路径（默认取 www/data_bak 或 www/data 中最大的 Map*.json）")
+    args = parser.parse_args()
+
+    map_file = args.map_file or find_largest_map()
+    raw = map_file.read_bytes() if map_file is not None else synth_map()
+    data = json_backend.loads(raw)
+    print(f"测试数据: {map_file or '合成地图'} ({len(raw) / 1024:.1f} KB)\n")
+
+    # 结果一致性
+    old_out, new_out = [], []
+    recursive_extract(data, old_out)
+    iterative_extract(data, new_out)
+    assert old_out == new_out, "提取结果不一致"
+    translations = [f"译{i}" for i in range(len(old_out))]
+    old_result = recursive_write_back(data, translations, [0])
+    new_result = iterative_write_back(copy.deepcopy(data), translations, [0])
+    assert old_result == new_result, "写回结果不一致"
+    print(f"提取与写回结果一致（{len(old_out)} 条字符串）\n")
+
+    # 写回会原地修改，每次使用新的副本；副本的复制时间单独扣除
+    copy_time = best_time(lambda: copy.deepcopy(data))
+    cases = [
+        ("递归 提取", lambda: recursive_extract(data, [])),
+        ("显式栈 提取", lambda: iterative_extract(data, [])),
+        ("递归 写回", lambda: recursive_write_back(data, translations, [0])),
+        ("显式栈 写回", lambda: iterative_write_back(copy.deepcopy(data), translations, [0])),
+    ]
+    print(f"{'项目':<16}{'耗时(ms)':>12}")
+    for name, func in cases:
+        elapsed = best_time(func)
+        if name == "显式栈 写回":
+            elapsed -= copy_time
+        print(f"{name:<16}{elapsed * 1000:>12.1f}")
+
+    # 递归深度
+    deep = "深い"
+    for _ in range(DEEP_NESTING):
+        deep = [deep]
+    try:
+        recursive_extract(deep, [])
+        print(f"\n递归版本: {DEEP_NESTING} 层嵌套正常")
+    except RecursionError:
+        print(f"\n递归版本: {DEEP_NESTING} 层嵌套超出递归深度限制 ({sys.getrecursionlimit()})")
+    out = []
+    iterative_extract(deep, out)
+    print(f"显式栈版本: {DEEP_NESTING} 层嵌套正常，提取 {len(out)} 条")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+import asyncio
+import hashlib
+import json
+import os
+import threading
+from pathlib import Path
+from typing import Dict, Iterator, List, Set
+
+import json_backend
+
+# ========== 配置 ==========
+JOURNAL_FILE = Path("json_temp") / "journal.jsonl"  # 每完成一个批次追加一行
+
+
+def batch_hash(texts: List[str]) -> str:
+    """批次内容哈希，只取决于原文本身，与批次所在位置、分批方式无关（固定用标准库序列化，与 JSON 后端无关）"""
+    payload = json.dumps(texts, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+
+class CheckpointJournal:
+    """
+    追加写入的检查点日志：每个完成的批次写一行 JSON 并 fsync，
+    崩溃时最多丢失正在写入的那一行。记录按原文内容寻址，
+    恢复时通过 build_index 得到 原文 → 译文 的索引，任意新的分批方式都能复用已翻译的内容。
+    """
+
+    def __init__(self, journal_file: Path = JOURNAL_FILE):
+        self.journal_file = Path(journal_file)
+        self.journal_file.parent.mkdir(exist_ok=True)
+        self._file = None
+        self._lock = threading.Lock()  # append_async 在线程池中写入，多个批次可能同时完成
+
+    def iter_records(self) -> Iterator[dict]:
+        """逐行读取日志记录；崩溃时写了一半的最后一行会被跳过"""
+        if not self.journal_file.exists():
+            return
+        with open(self.journal_file, "rb") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    yield json_backend.loads(line)
+                except ValueError:  # json.JSONDecodeError 与 orjson.JSONDecodeError 均为 ValueError 子类
+                    continue
+
+    def completed_hashes(self) -> Set[str]:
+        return {record["hash"] for record in self.iter_records()}
+
+    def build_index(self) -> Dict[str, str]:
+        """单次顺序读取日志，建立 原文 → 译文 的索引（同一原文以最后一次记录为准）"""
+        index = {}
+        for record in self.iter_records():
+            index.update(zip(record["sources"], record["translated"]))
+        return index
+
+    def append(self, sources: List[str], translated: List[str], key: str = None):
+        """追加一个完成的批次并立即落盘"""
+        record = {"hash": key or batch_hash(sources), "sources": sources, "translated": translated}
+        line = json_backend.dumps(record, "compact") + b"\n"
+        with self._lock:
+            if self._file is None:
+                self._file = self._open_for_append()
+            self._file.write(line)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def _open_for_append(self):
+        """以追加方式打开日志；上次崩溃留下的半行先补上换行，避免新记录接在它后面被一起丢弃"""
+        f = open(self.journal_file, "ab")
+        if f.tell() > 0:
+            with open(self.journal_file, "rb") as existing:
+                existing.seek(-1, os.SEEK_END)
+                if existing.read(1) != b"\n":
+                    f.write(b"\n")
+        return f
+
+    async def append_async(self, sources: List[str], translated: List[str], key: str = None):
+        """在线程池中执行 append：fsync 可能耗时数十毫秒，直接在事件循环中执行会阻塞所有在途的流式请求"""
+        await asyncio.to_thread(self.append, sources, translated, key)
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
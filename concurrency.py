@@ -0,0 +1,180 @@
+import asyncio
+import json
+import os
+import random
+import time
+from contextlib import asynccontextmanager
+from email.utils import parsedate_to_datetime
+from pathlib import Path
+from typing import Optional
+
+import openai
+
+# ========== 配置 ==========
+BACKOFF_BASE = 1.0    # 指数退避的初始等待秒数
+BACKOFF_CAP = 60.0    # 单次退避的最大等待秒数
+DECREASE_FACTOR = 0.5  # 遇到 429/5xx 时并发数的乘性缩减系数
+EWMA_ALPHA = 0.2      # 延迟滑动平均的平滑系数
+ERROR_WINDOW = 50     # 计算错误率的最近请求数
+MAX_ERROR_RATE = 0.1  # 错误率高于该值时不再增加并发
+
+
+def is_throttle_error(e: Exception) -> bool:
+    """429、5xx 以及超时/连接错误视为服务端过载信号"""
+    if isinstance(e, openai.RateLimitError):
+        return True
+    if isinstance(e, openai.APIStatusError):
+        return e.status_code == 429 or e.status_code >= 500
+    return isinstance(e, (openai.APITimeoutError, openai.APIConnectionError))
+
+
+def retry_after_seconds(e: Exception) -> Optional[float]:
+    """从异常携带的响应头中读取 Retry-After（支持秒数、毫秒与HTTP日期格式）"""
+    response = getattr(e, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+
+    retry_after_ms = headers.get("retry-after-ms")
+    if retry_after_ms:
+        try:
+            return max(float(retry_after_ms) / 1000, 0.0)
+        except ValueError:
+            pass
+
+    retry_after = headers.get("retry-after")
+    if not retry_after:
+        return None
+    try:
+        return max(float(retry_after), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(retry_after).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt: int, retry_after: Optional[float] = None) -> float:
+    """带完全抖动的指数退避；服务端给出 Retry-After 时以其为下限，避免所有请求同时重试"""
+    delay = random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+    if retry_after is not None:
+        delay = retry_after + random.uniform(0, BACKOFF_BASE)
+    return delay
+
+
+class AdaptiveLimiter:
+    """
+    AIMD 并发控制器：延迟与错误率正常时每完成约 limit 个请求并发数 +1，
+    遇到 429/5xx 时乘性缩减。当前并发数定期导出到 metrics_file。
+    """
+
+    def __init__(self, initial: int, minimum: int, maximum: int, target_latency: float,
+                 metrics_file: Optional[Path] = None):
+        self.limit = max(minimum, min(initial, maximum))
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target_latency = target_latency
+        self.metrics_file = Path(metrics_file) if metrics_file else None
+
+        self.in_flight = 0
+        self.successes = 0
+        self.throttled = 0
+        self.errors = 0
+        self.latency_ewma: Optional[float] = None
+        self._recent_errors = []
+        self._increase_credit = 0.0
+        self._last_decrease = 0.0
+        self._condition = asyncio.Condition()
+
+    @asynccontextmanager
+    async def slot(self):
+        """占用一个请求名额，超过当前并发上限时等待"""
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.in_flight < self.limit)
+            self.in_flight += 1
+        try:
+            yield
+        finally:
+            async with self._condition:
+                self.in_flight -= 1
+                self._condition.notify_all()
+
+    def _record_outcome(self, failed: bool):
+        self._recent_errors.append(failed)
+        if len(self._recent_errors) > ERROR_WINDOW:
+            self._recent_errors.pop(0)
+
+    @property
+    def error_rate(self) -> float:
+        return sum(self._recent_errors) / len(self._recent_errors) if self._recent_errors else 0.0
+
+    def on_success(self, latency: float):
+        """请求成功：更新延迟，健康时加性增加并发"""
+        self.successes += 1
+        self._record_outcome(False)
+        if self.latency_ewma is None:
+            self.latency_ewma = latency
+        else:
+            self.latency_ewma = EWMA_ALPHA * latency + (1 - EWMA_ALPHA) * self.latency_ewma
+
+        if self.latency_ewma <= self.target_latency and self.error_rate <= MAX_ERROR_RATE:
+            self._increase_credit += 1 / self.limit
+            if self._increase_credit >= 1 and self.limit < self.maximum:
+                self._increase_credit = 0.0
+                self._set_limit(self.limit + 1)
+        if self.successes % 20 == 0:
+            self.export_metrics()
+
+    def on_throttle(self):
+        """遇到 429/5xx：乘性缩减并发；同一波失败（一个平均延迟内）只缩减一次"""
+        self.throttled += 1
+        self._record_outcome(True)
+        now = time.monotonic()
+        if now - self._last_decrease < (self.latency_ewma or BACKOFF_BASE):
+            return
+        self._last_decrease = now
+        self._increase_credit = 0.0
+        self._set_limit(max(self.minimum, int(self.limit * DECREASE_FACTOR)))
+
+    def on_error(self):
+        """其他错误（如解析失败）只计入错误率，不调整并发"""
+        self.errors += 1
+        self._record_outcome(True)
+
+    def _set_limit(self, limit: int):
+        self.limit = limit
+        self.export_metrics()
+
+        # 上限提高后唤醒等待中的请求
+        async def _wake():
+            async with self._condition:
+                self._condition.notify_all()
+        asyncio.get_running_loop().create_task(_wake())
+
+    def metrics(self) -> dict:
+        return {
+            "concurrency_limit": self.limit,
+            "in_flight": self.in_flight,
+            "successes": self.successes,
+            "throttled": self.throttled,
+            "errors": self.errors,
+            "error_rate": round(self.error_rate, 4),
+            "latency_ewma": round(self.latency_ewma, 3) if self.latency_ewma is not None else None,
+            "updated_at": time.time(),
+        }
+
+    def export_metrics(self):
+        """写入指标文件（先写临时文件再替换，读取方不会看到半截内容）"""
+        if self.metrics_file is None:
+            return
+        self.metrics_file.parent.mkdir(exist_ok=True)
+        tmp_file = self.metrics_file.with_suffix(".tmp")
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump(self.metrics(), f, ensure_ascii=False, indent=2)
+        os.replace(tmp_file, self.metrics_file)
+
+    def summary(self) -> str:
+        latency = f"{self.latency_ewma:.1f}秒" if self.latency_ewma is not None else "-"
+        return (f"并发控制: 当前上限 {self.limit}, 成功 {self.successes} 次, 限流/过载 {self.throttled} 次, "
+                f"其他错误 {self.errors} 次, 平均延迟 {latency}")
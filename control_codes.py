@@ -0,0 +1,47 @@
+import re
+from collections import Counter
+from typing import List, Optional, Tuple
+
+# ========== 配置 ==========
+# RPG Maker 文本控制符：\C[n] \N[n] \V[n] \I[n] \P[n] \G \{ \} \\ \$ \. \| \! \> \< \^，
+# 以及插件常见的 \FS[n]、\AA<名字> 等；相邻的多个控制符合并为一个占位符
+CONTROL_CODE = re.compile(r"(?:\\[A-Za-z]+(?:\[[^\]\n]*\]|<[^>\n]*>)?|\\[{}\\$.|!><^])+")
+PLACEHOLDER = re.compile(r"\{(\d+)\}")
+
+
+def mask_text(text: str) -> Tuple[str, Optional[List[str]]]:
+    """
+    将控制符替换为 {1}、{2}… 形式的占位符，返回 (替换后的文本, 按编号排列的控制符)；
+    没有控制符，或原文本身含有占位符形式的内容（无法区分）时原样返回，控制符为 None
+    """
+    if "\\" not in text or PLACEHOLDER.search(text):
+        return text, None
+    codes = []
+
+    def _replace(match):
+        codes.append(match.group(0))
+        return f"{{{len(codes)}}}"
+
+    masked = CONTROL_CODE.sub(_replace, text)
+    return (masked, codes) if codes else (text, None)
+
+
+def mask_texts(texts: List[str]) -> Tuple[List[str], List[Optional[List[str]]]]:
+    masked, codes = [], []
+    for text in texts:
+        m, c = mask_text(text)
+        masked.append(m)
+        codes.append(c)
+    return masked, codes
+
+
+def placeholders_match(source: str, translated: str) -> bool:
+    """译文中的占位符必须与原文完全一致（每个编号出现的次数相同）"""
+    return Counter(PLACEHOLDER.findall(source)) == Counter(PLACEHOLDER.findall(translated))
+
+
+def unmask_text(translated: str, codes: Optional[List[str]]) -> str:
+    """将占位符还原为控制符（调用方需先用 placeholders_match 校验）"""
+    if not codes:
+        return translated
+    return PLACEHOLDER.sub(lambda m: codes[int(m.group(1)) - 1], translated)
@@ -0,0 +1,135 @@
+import copy
+import re
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+import json_backend
+
+# ========== 配置 ==========
+RULES_FILE = Path("extraction_rules.json")  # 按游戏覆盖默认规则（可选），格式与 DEFAULT_RULES 相同
+MAP_FILE_REGEX = re.compile(r"^Map\d+\.json$")
+SHOW_TEXT_CODE = 101   # 显示文字
+TEXT_LINE_CODE = 401   # 文字内容（每行一条指令）
+
+# 默认规则（RPG Maker MV/MZ）
+DEFAULT_RULES = {
+    # 路径中出现这些键的字符串是素材引用或插件数据，一律不提取
+    "exclude_keys": [
+        "image", "characterName", "faceName", "battlerName", "note",
+        "bgm", "bgs", "me", "se", "sounds", "autoplayBgm", "autoplayBgs",
+        "parallaxName", "battleback1Name", "battleback2Name",
+        "title1Name", "title2Name", "animation1Name", "animation2Name",
+    ],
+    # 事件指令: 指令编号 → 需要提取的参数下标
+    "event_codes": {
+        "101": [4],  # 显示文字（MZ 的姓名框）
+        "401": [0],  # 文字内容
+        "102": [0],  # 显示选项
+        "402": [1],  # 选择选项时
+        "405": [0],  # 滚动文字内容
+        "320": [1],  # 更改名字
+        "324": [1],  # 更改昵称
+        "325": [1],  # 更改简介
+    },
+    # 数据库文件: 文件类型 → 需要提取的字段（数组文件为每个元素的字段，对象文件为顶层字段）
+    "fields": {
+        "Actors": ["name", "nickname", "profile"],
+        "Classes": ["name"],
+        "Skills": ["name", "description", "message1", "message2"],
+        "Items": ["name", "description"],
+        "Weapons": ["name", "description"],
+        "Armors": ["name", "description"],
+        "Enemies": ["name"],
+        "States": ["name", "message1", "message2", "message3", "message4"],
+        "System": ["gameTitle", "currencyUnit", "elements", "skillTypes", "weaponTypes",
+                   "armorTypes", "equipTypes", "terms"],
+        "Map": ["displayName"],
+        "MapInfos": [],
+        "CommonEvents": [],
+        "Troops": [],
+        "Animations": [],
+        "Tilesets": [],
+    },
+    # 不在 fields 中的文件（如插件自带的数据文件）: "all" 提取所有含日文的字符串, "none" 不提取
+    "unknown_files": "all",
+}
+
+
+class ExtractionRules:
+    """按文件类型与事件指令编号判断一个字符串是否需要翻译"""
+
+    def __init__(self, rules: dict):
+        self.exclude_keys = set(rules["exclude_keys"])
+        self.event_codes = {int(code): set(params) for code, params in rules["event_codes"].items()}
+        self.fields = {file_type: set(fields) for file_type, fields in rules["fields"].items()}
+        self.unknown_files = rules["unknown_files"]
+
+    @staticmethod
+    def file_type(file_name: str) -> str:
+        return "Map" if MAP_FILE_REGEX.match(file_name) else Path(file_name).stem
+
+    def accepts(self, file_name: str, path: tuple, root) -> bool:
+        """path 为字符串在文件中的键路径，root 为整个文件的数据"""
+        if any(key in self.exclude_keys for key in path if isinstance(key, str)):
+            return False
+
+        # 事件指令：取路径中最后一个 list/下标/parameters 三元组对应的指令
+        for i in range(len(path) - 4, -1, -1):
+            if path[i] == "list" and isinstance(path[i + 1], int) and path[i + 2] == "parameters":
+                command = root
+                for key in path[:i + 2]:
+                    command = command[key]
+                allowed = self.event_codes.get(command.get("code")) if isinstance(command, dict) else None
+                return allowed is not None and path[i + 3] in allowed
+
+        fields = self.fields.get(self.file_type(file_name))
+        if fields is None:
+            return self.unknown_files == "all"
+        field = next((key for key in path if isinstance(key, str)), None)
+        return field in fields
+
+
+def message_block(root, path: tuple) -> Optional[Tuple[tuple, List[tuple], List[str]]]:
+    """
+    path 指向某条"文字内容"(401) 的文本时，返回其所在对话框的 (块的键, 各行的路径, 各行文本)：
+    同一个"显示文字"(101) 之后连续的 401 指令属于同一个对话框。其他位置返回 None。
+    """
+    if len(path) < 4 or path[-4] != "list" or not isinstance(path[-3], int) or path[-2:] != ("parameters", 0):
+        return None
+    commands = root
+    for key in path[:-3]:
+        commands = commands[key]
+
+    def code_at(index):
+        command = commands[index]
+        return command.get("code") if isinstance(command, dict) else None
+
+    if code_at(path[-3]) != TEXT_LINE_CODE:
+        return None
+    start = path[-3]
+    while start > 0 and code_at(start - 1) == TEXT_LINE_CODE:
+        start -= 1
+    end = path[-3]
+    while end + 1 < len(commands) and code_at(end + 1) == TEXT_LINE_CODE:
+        end += 1
+
+    list_path = path[:-3]
+    line_paths = [(*list_path, i, "parameters", 0) for i in range(start, end + 1)]
+    lines = [commands[i]["parameters"][0] if commands[i].get("parameters") else None for i in range(start, end + 1)]
+    if not all(isinstance(line, str) for line in lines):
+        return None
+    return (*list_path, start), line_paths, lines
+
+
+def load_rules(rules_file: Path = RULES_FILE) -> ExtractionRules:
+    """读取默认规则，并用 rules_file 中的同名项覆盖（fields 与 event_codes 按键合并）"""
+    rules = copy.deepcopy(DEFAULT_RULES)
+    if rules_file.exists():
+        overrides = json_backend.load_file(rules_file)
+        for key, value in overrides.items():
+            if key in ("fields", "event_codes"):
+                rules[key].update(value)
+            else:
+                rules[key] = value
+        print(f"已加载提取规则: {rules_file}")
+    return ExtractionRules(rules)
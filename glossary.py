@@ -0,0 +1,127 @@
+import re
+from collections import deque
+from pathlib import Path
+from typing import Dict, Iterable, List, Set, Tuple
+
+import json_backend
+
+# ========== 配置 ==========
+GLOSSARY_FILE = Path("glossary.json")  # {日文术语: 中文译名}，可手动修改，修改后的译名优先
+GLOSSARY_SOURCES = {  # 数据库文件 → 作为术语的字段
+    "Actors.json": ["name", "nickname"],
+    "Items.json": ["name"],
+    "Skills.json": ["name"],
+    "Weapons.json": ["name"],
+    "Armors.json": ["name"],
+    "Enemies.json": ["name"],
+    "MapInfos.json": ["name"],
+}
+MIN_TERM_LENGTH = 2       # 过短的术语容易误匹配
+MAX_TERMS_PER_BATCH = 30  # 单个批次最多注入的术语数
+JP_REGEX = re.compile(r'[\u3040-\u30ff\u4e00-\u9fff]+')
+
+
+class AhoCorasick:
+    """多模式串匹配：一次扫描文本即可找出其中出现的所有术语"""
+
+    def __init__(self, patterns: Iterable[str]):
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._output: List[List[str]] = [[]]
+        for pattern in patterns:
+            self._add(pattern)
+        self._build()
+
+    def _add(self, pattern: str):
+        node = 0
+        for char in pattern:
+            nxt = self._goto[node].get(char)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto[node][char] = nxt
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append([])
+            node = nxt
+        self._output[node].append(pattern)
+
+    def _build(self):
+        """按广度优先计算失败指针，并把失败指针链上的输出合并到当前节点"""
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in self._goto[node].items():
+                queue.append(child)
+                fail = self._fail[node]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[child] = self._goto[fail].get(char, 0)
+                self._output[child] = self._output[child] + self._output[self._fail[child]]
+
+    def find_all(self, text: str) -> Set[str]:
+        found = set()
+        node = 0
+        for char in text:
+            while node and char not in self._goto[node]:
+                node = self._fail[node]
+            node = self._goto[node].get(char, 0)
+            if self._output[node]:
+                found.update(self._output[node])
+        return found
+
+
+class Glossary:
+    """术语表：为每个批次找出其中出现的术语，生成注入提示词的对照表"""
+
+    def __init__(self, entries: Dict[str, str]):
+        self.entries = entries
+        self._matcher = AhoCorasick(entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def relevant(self, texts: List[str]) -> List[Tuple[str, str]]:
+        """批次中出现的术语（长的优先，最多 MAX_TERMS_PER_BATCH 条）"""
+        found = set()
+        for text in texts:
+            found |= self._matcher.find_all(text)
+        terms = sorted(found, key=lambda term: (-len(term), term))[:MAX_TERMS_PER_BATCH]
+        return [(term, self.entries[term]) for term in terms]
+
+    @staticmethod
+    def format(terms: List[Tuple[str, str]]) -> str:
+        return "\n".join(f"{source} → {target}" for source, target in terms)
+
+
+def collect_terms(data_dir: Path) -> List[str]:
+    """从数据库文件中收集含日文的名称，按文件与出现顺序去重"""
+    terms = {}
+    for file_name, fields in GLOSSARY_SOURCES.items():
+        file_path = data_dir / file_name
+        if not file_path.exists():
+            continue
+        try:
+            content = json_backend.load_file(file_path)
+        except Exception as e:
+            print(f"[错误] 读取术语来源 {file_path}: {e}")
+            continue
+        for entry in content:
+            if not isinstance(entry, dict):
+                continue
+            for field in fields:
+                value = entry.get(field)
+                if isinstance(value, str):
+                    value = value.strip()
+                    if len(value) >= MIN_TERM_LENGTH and JP_REGEX.search(value):
+                        terms.setdefault(value, None)
+    return list(terms)
+
+
+def load_glossary(glossary_file: Path = GLOSSARY_FILE) -> Dict[str, str]:
+    if not glossary_file.exists():
+        return {}
+    return json_backend.load_file(glossary_file)
+
+
+def save_glossary(entries: Dict[str, str], glossary_file: Path = GLOSSARY_FILE):
+    json_backend.dump_file(entries, glossary_file)
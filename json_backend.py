@@ -0,0 +1,71 @@
+import json
+from pathlib import Path
+
+try:
+    import orjson
+except ImportError:  # 未安装时使用标准库
+    orjson = None
+
+# ========== 配置 ==========
+BACKEND = "orjson" if orjson is not None else "json"
+OUTPUT_STYLE = "preserve"  # 游戏数据的输出格式: preserve（沿用原文件格式）/ compact / lines / indent
+
+# 输出格式:
+#   compact: 无空白的紧凑格式
+#   lines:   RPG Maker MV/MZ 数据库文件的格式，顶层数组每个元素一行，元素内部紧凑
+#   indent:  两空格缩进（旧版写回脚本的格式）
+STYLES = ("compact", "lines", "indent")
+
+
+def loads(data):
+    """解析 JSON，data 可以是 bytes 或 str（兼容带 BOM 的文件）"""
+    if isinstance(data, (bytes, bytearray)) and data.startswith(b"\xef\xbb\xbf"):
+        data = data[3:]
+    if orjson is not None:
+        return orjson.loads(data)
+    if isinstance(data, (bytes, bytearray)):
+        data = data.decode("utf-8")
+    return json.loads(data)
+
+
+def load_file(path: Path):
+    with open(path, "rb") as f:
+        return loads(f.read())
+
+
+def detect_style(raw: bytes) -> str:
+    """根据原文件开头判断其格式"""
+    if raw.startswith(b"\xef\xbb\xbf"):
+        raw = raw[3:]
+    head = raw[:64].lstrip()
+    if head[:1] not in (b"[", b"{"):
+        return "compact"
+    rest = head[1:]
+    if rest.startswith(b"\n ") or rest.startswith(b"\r\n "):
+        return "indent"
+    if head[:1] == b"[" and rest[:1] in (b"\n", b"\r"):
+        return "lines"
+    return "compact"
+
+
+def dumps(obj, style: str = "indent") -> bytes:
+    """序列化为 UTF-8 bytes（中文不转义）"""
+    if style == "lines" and isinstance(obj, list):
+        if not obj:
+            return b"[\n]"
+        return b"[\n" + b",\n".join(dumps(item, "compact") for item in obj) + b"\n]"
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if style == "indent" else 0)
+    if style == "indent":
+        return json.dumps(obj, ensure_ascii=False, indent=2).encode("utf-8")
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def dump_file(obj, path: Path, style: str = "indent"):
+    with open(path, "wb") as f:
+        f.write(dumps(obj, style))
+
+
+def output_style(raw: bytes) -> str:
+    """按 OUTPUT_STYLE 决定写回游戏数据时使用的格式"""
+    return detect_style(raw) if OUTPUT_STYLE == "preserve" else OUTPUT_STYLE
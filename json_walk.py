@@ -0,0 +1,42 @@
+from typing import Any, Callable, Iterator, Optional, Tuple
+
+# 以显式栈遍历 JSON 结构，不复制容器、不受递归深度限制。
+# 遍历顺序与递归版本一致（深度优先，字典按键的插入顺序、列表按下标），
+# 提取顺序、清单ID与旧版逐条写回的位置因此保持不变。
+
+
+def _children(node) -> Iterator[Tuple[Any, Any]]:
+    return iter(node.items()) if isinstance(node, dict) else enumerate(node)
+
+
+def iter_string_slots(obj, predicate: Optional[Callable[[str], Any]] = None) -> Iterator[Tuple[Any, Any, tuple, str]]:
+    """
+    逐个产出字符串叶子 (所在容器, 键或下标, 路径, 字符串)，可通过 容器[键] = 新值 原地修改。
+    predicate 不为空时只产出使其为真的字符串，路径元组只为这些字符串创建。
+    """
+    if not isinstance(obj, (dict, list)):
+        return
+    path = []             # 当前容器的键路径
+    containers = [obj]    # 当前容器及其祖先
+    stack = [_children(obj)]
+    while stack:
+        for key, value in stack[-1]:
+            if isinstance(value, str):
+                if predicate is None or predicate(value):
+                    yield containers[-1], key, (*path, key), value
+            elif isinstance(value, (dict, list)):
+                path.append(key)
+                containers.append(value)
+                stack.append(_children(value))
+                break
+        else:
+            stack.pop()
+            containers.pop()
+            if path:
+                path.pop()
+
+
+def iter_strings(obj, predicate: Optional[Callable[[str], Any]] = None) -> Iterator[Tuple[tuple, str]]:
+    """逐个产出字符串叶子 (路径, 字符串)"""
+    for _, _, path, value in iter_string_slots(obj, predicate):
+        yield path, value
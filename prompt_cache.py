@@ -0,0 +1,88 @@
+from typing import List, Optional, Tuple
+
+from glossary import Glossary
+
+# ========== 配置 ==========
+# DeepSeek 对与之前请求相同的提示词前缀按缓存价格计费，因此固定内容（系统提示词、完整术语表、示例）
+# 放在最前面且逐字节不变，每个批次变化的内容（相关术语、待翻译文本）放在最后
+GLOSSARY_PREFIX_MAX_TERMS = 300  # 术语表不超过该条数时整个放入固定前缀，否则每批只注入相关术语
+INPUT_PRICE = 0.002              # 未命中缓存的输入价格 元/千tokens（与 usage_ledger.PRICES 一致）
+CACHE_HIT_PRICE = 0.0005         # 命中缓存的输入价格 元/千tokens
+
+# 固定的风格示例：演示编号格式、多行对话与占位符的处理
+STYLE_EXAMPLES = [
+    (
+        "翻译以下日文为中文：\n"
+        "1. {1}村長{2}：よく来てくれた。\n北の洞窟に魔物が現れたのだ。\n"
+        "2. {1}ゴールドを手に入れた！\n"
+        "3. はい",
+        "1. {1}村长{2}：你能来真是太好了。\n北边的洞窟里出现了魔物。\n"
+        "2. 获得了{1}金币！\n"
+        "3. 是",
+    ),
+]
+
+
+def cache_tokens(usage) -> Tuple[Optional[int], Optional[int]]:
+    """从 usage 中读取 (命中缓存的输入token, 未命中的输入token)；兼容 DeepSeek 与 OpenAI 的字段"""
+    if usage is None:
+        return None, None
+    hit = getattr(usage, "prompt_cache_hit_tokens", None)
+    miss = getattr(usage, "prompt_cache_miss_tokens", None)
+    if hit is None:
+        details = getattr(usage, "prompt_tokens_details", None)
+        hit = getattr(details, "cached_tokens", None)
+        if hit is not None and getattr(usage, "prompt_tokens", None) is not None:
+            miss = usage.prompt_tokens - hit
+    return hit, miss
+
+
+class PromptBuilder:
+    """生成请求消息：固定前缀只在创建时生成一次，保证每个请求的前缀逐字节相同"""
+
+    def __init__(self, system_prompt: str, glossary: Optional[Glossary] = None,
+                 examples: List[Tuple[str, str]] = STYLE_EXAMPLES):
+        self.glossary = glossary
+        self.glossary_in_prefix = glossary is not None and len(glossary) <= GLOSSARY_PREFIX_MAX_TERMS
+
+        system = system_prompt
+        if self.glossary_in_prefix:
+            terms = sorted(glossary.entries.items())
+            system += f"\n\n术语表（出现时请使用以下译名）：\n{Glossary.format(terms)}"
+        self.prefix = [{"role": "system", "content": system}]
+        for user, assistant in examples:
+            self.prefix.append({"role": "user", "content": user})
+            self.prefix.append({"role": "assistant", "content": assistant})
+
+    def build(self, batch: List[str], combined: str) -> List[dict]:
+        content = f"翻译以下日文为中文：\n{combined}"
+        if self.glossary is not None and not self.glossary_in_prefix:
+            terms = self.glossary.relevant(batch)
+            if terms:
+                content = f"术语表（出现时请使用以下译名）：\n{Glossary.format(terms)}\n\n{content}"
+        return self.prefix + [{"role": "user", "content": content}]
+
+
+class CacheStats:
+    """逐个请求记录提示词缓存的命中情况，并在运行结束时汇总"""
+
+    def __init__(self):
+        self.requests: List[Tuple[str, int, int]] = []  # (批次ID, 命中token, 未命中token)
+        self.unreported = 0
+
+    def record(self, batch_id: str, usage):
+        hit, miss = cache_tokens(usage)
+        if hit is None or miss is None:
+            self.unreported += 1
+            return
+        self.requests.append((batch_id, hit, miss))
+
+    def summary(self) -> str:
+        hit = sum(r[1] for r in self.requests)
+        miss = sum(r[2] for r in self.requests)
+        total = hit + miss
+        if not total:
+            return f"提示词缓存: 没有返回缓存用量的请求（{self.unreported} 个请求未返回）"
+        saved = hit / 1000 * (INPUT_PRICE - CACHE_HIT_PRICE)
+        return (f"提示词缓存: {len(self.requests)} 个请求, 命中 {hit} / 未命中 {miss} tokens, "
+                f"命中率 {hit / total:.1%}, 节省输入费用约 ¥{saved:.2f}")
@@ -0,0 +1,133 @@
+import hashlib
+import re
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+
+import json_backend
+
+# ========== 配置 ==========
+MANIFEST_FILE = Path("translation_manifest.json")  # 与 translation_strings.json 一一对应的字符串清单
+BASELINE_FILE = Path("translation_baseline.json")  # 上一次写回时的 (ID, 原文哈希, 译文)，供增量模式比对
+REUSE_FILE = Path("translation_reuse.json")  # 增量模式下可直接复用的译文，与 translation_strings.json 一一对应，null 表示需要翻译
+STATUS_FILE = Path("translation_status.json")  # 与 translation_strings_cn.json 一一对应，false 表示翻译失败、保留的原文
+KANA_REGEX = re.compile(r'[\u3041-\u3096\u30a1-\u30fa]')  # 与 translate_v4 一致：译文仍含假名视为未翻译
+
+
+def json_pointer(path: Sequence[Union[str, int]]) -> str:
+    """将键路径转换为 JSON Pointer（RFC 6901），如 ["events", 1, "name"] → "/events/1/name" """
+    return "".join("/" + str(token).replace("~", "~0").replace("/", "~1") for token in path)
+
+
+def parse_pointer(pointer: str) -> List[str]:
+    """将 JSON Pointer 拆分为键列表（列表下标保持为字符串，由调用方按容器类型转换）"""
+    if not pointer:
+        return []
+    return [token.replace("~1", "/").replace("~0", "~") for token in pointer[1:].split("/")]
+
+
+def source_hash(text: str) -> str:
+    """原文哈希，用于写回时确认目标位置的原文没有变化"""
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()[:16]
+
+
+def make_record(file_name: str, path: Sequence[Union[str, int]], text: str,
+                line_paths: Optional[List[Sequence[Union[str, int]]]] = None) -> dict:
+    """
+    生成一条清单记录：id 由文件名和 JSON Pointer 组成，与提取顺序无关。
+    多行合并为一条翻译时，line_paths 为各行的位置，记录在 pointers 中（text 为各行以换行连接后的文本）
+    """
+    pointer = json_pointer(path)
+    record = {"id": f"{file_name}#{pointer}", "file": file_name, "pointer": pointer, "hash": source_hash(text)}
+    if line_paths:
+        record["pointers"] = [json_pointer(p) for p in line_paths]
+    return record
+
+
+def save_manifest(records: List[dict], manifest_file: Path = MANIFEST_FILE):
+    json_backend.dump_file(records, manifest_file)
+
+
+def load_manifest(manifest_file: Path = MANIFEST_FILE) -> List[dict]:
+    return json_backend.load_file(manifest_file)
+
+
+def group_translations_by_file(records: List[dict], translations: List[str]) -> Dict[str, Dict[str, tuple]]:
+    """按文件分组，返回 {文件名: {pointer: (原文哈希, 译文, 多行合并时各行的 pointer 列表或 None)}}"""
+    if len(records) != len(translations):
+        raise ValueError(f"清单条数 ({len(records)}) 与翻译结果条数 ({len(translations)}) 不一致")
+    by_file: Dict[str, Dict[str, tuple]] = {}
+    for record, translated in zip(records, translations):
+        by_file.setdefault(record["file"], {})[record["pointer"]] = (record["hash"], translated, record.get("pointers"))
+    return by_file
+
+
+def save_baseline(records: List[dict], translations: List[str], status: Optional[List[bool]] = None,
+                  baseline_file: Path = BASELINE_FILE):
+    """保存本次写回的基线：每条记录的 ID、原文哈希与最终译文；给定 status 时记录每条是否由模型翻译"""
+    baseline = [
+        {"id": record["id"], "hash": record["hash"], "translation": translated}
+        for record, translated in zip(records, translations)
+    ]
+    if status is not None:
+        for entry, translated in zip(baseline, status):
+            entry["translated"] = translated
+    json_backend.dump_file(baseline, baseline_file)
+
+
+def load_baseline(baseline_file: Path = BASELINE_FILE) -> List[dict]:
+    return json_backend.load_file(baseline_file)
+
+
+def is_translated(source: str, translated: Optional[str], produced: Optional[bool] = None) -> bool:
+    """
+    produced 为基线中记录的该条是否由模型翻译（纯汉字原文的正确译文可能与原文相同，只能按记录判断）；
+    旧版基线没有该记录时按内容判断：译文与原文相同（翻译失败时保留的原文）或原文含假名而译文仍含假名时视为未翻译
+    """
+    if not isinstance(translated, str):
+        return False
+    if produced is not None:
+        return produced
+    if translated == source:
+        return False
+    return not (KANA_REGEX.search(source) and KANA_REGEX.search(translated))
+
+
+def compute_reuse(records: List[dict], baseline: List[dict],
+                  texts: List[str]) -> Tuple[List[Optional[str]], Dict[str, int]]:
+    """
+    将本次提取的清单与基线比对，返回与清单等长的可复用译文列表（None 表示需要翻译）及统计。
+    同一 ID 且原文哈希相同视为未变化；ID 不同但原文在基线中出现过（如插入事件导致下标移动）同样复用译文。
+    texts 为与清单对应的本次原文：哈希相同即原文相同，基线中实际未翻译的条目（见 is_translated）重新翻译，
+    不会被增量模式一直沿用。
+    """
+    by_id = {entry["id"]: entry for entry in baseline}
+    by_hash: Dict[str, List[dict]] = {}
+    for entry in baseline:
+        by_hash.setdefault(entry["hash"], []).append(entry)
+    stats = {"unchanged": 0, "moved": 0, "untranslated": 0, "changed": 0, "new": 0, "removed": 0}
+    reuse: List[Optional[str]] = []
+
+    for record, text in zip(records, texts):
+        previous = by_id.get(record["id"])
+        candidates = by_hash.get(record["hash"], [])
+        moved = next((entry["translation"] for entry in candidates
+                      if is_translated(text, entry["translation"], entry.get("translated"))), None)
+        if previous is not None and previous["hash"] == record["hash"] \
+                and is_translated(text, previous["translation"], previous.get("translated")):
+            reuse.append(previous["translation"])
+            stats["unchanged"] += 1
+        elif moved is not None:
+            reuse.append(moved)
+            stats["moved"] += 1
+        elif candidates:
+            reuse.append(None)  # 原文未变化但上次没有翻译成功
+            stats["untranslated"] += 1
+        else:
+            reuse.append(None)
+            stats["changed" if previous is not None else "new"] += 1
+
+    current_ids = {record["id"] for record in records}
+    current_hashes = {record["hash"] for record in records}
+    stats["removed"] = sum(1 for entry in baseline
+                           if entry["id"] not in current_ids and entry["hash"] not in current_hashes)
+    return reuse, stats
@@ -1,22 +1,35 @@
 import os
-import json
+import argparse
 import shutil
 import re
 import random
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 from pathlib import Path
+from typing import List, Optional, Tuple
 from tqdm import tqdm
+import json_backend
+from json_walk import iter_strings
+from extraction_rules import ExtractionRules, RULES_FILE, load_rules, message_block
+from string_manifest import (MANIFEST_FILE, BASELINE_FILE, REUSE_FILE, make_record, save_manifest,
+                             load_baseline, compute_reuse)
 
 # ========== 配置 ==========
 SOURCE_DIR = Path("www/data")
 BACKUP_DIR = Path("www/data_bak")
 OUTPUT_FILE = Path("translation_strings.json")  # 保存需要翻译的字符串
 SAMPLE_SIZE = 5  # 随机采样的数量
+EXCLUDED_FILES = ["CommonEvents.json", "Tilesets.json"]  # 不翻译的文件（写回时从备份恢复）
+MERGE_MESSAGE_LINES = True  # 同一个"显示文字"(101) 下连续的 401 行合并为一条翻译，写回时按原行数重新分配
+USE_RULES = True  # 按文件类型与事件指令提取（见 extraction_rules.py），False 时提取所有含日文的字符串
+JOBS = 1  # 并行处理文件的进程数，1 为单进程（可用 --jobs 覆盖）
 JP_REGEX = re.compile(r'[\u3040-\u30ff\u4e00-\u9fff]+')  # 检测日文字符
 
 # ========== 统计变量 ==========
 translation_count = 0
 total_tokens = 0
 strings_to_translate = []  # 存储所有需要翻译的字符串
+manifest_records = []  # 与 strings_to_translate 一一对应的清单（文件、JSON Pointer、原文哈希）
 
 # ========== 备份函数 ==========
 def backup_data_dir():
@@ -27,8 +40,7 @@ def backup_data_dir():
         print(f"已备份 {SOURCE_DIR} 到 {BACKUP_DIR}")
 
         # 删除指定文件
-        files_to_delete = ["CommonEvents.json", "Tilesets.json"]
-        for file in files_to_delete:
+        for file in EXCLUDED_FILES:
             file_path = SOURCE_DIR / file
             try:
                 if file_path.exists():
@@ -40,43 +52,58 @@ def backup_data_dir():
                 print(f"删除文件 {file_path} 时出错: {e}")
 
 # ========== 模拟翻译函数 ==========
-def gpt_translate(text: str) -> str:
-    global translation_count, input_tokens, output_tokens, total_tokens, strings_to_translate
-    
-    # 记录需要翻译的字符串
+def gpt_translate(text: str, file_name: str = "", path: tuple = (), line_paths: Optional[list] = None) -> str:
+    # 记录需要翻译的字符串及其位置（合并的多行对话时 line_paths 为各行位置）
     strings_to_translate.append(text)
-    
-    # 模拟翻译请求
-    translation_count += 1
-    
-    # 估算token数量 (日文和中文通常1字符≈1token)
-    input_token = len(text)
-    output_token = len(text) * 1.2  # 假设中文输出比日文长20%
-    input_tokens += input_token
-    output_tokens += output_token
-    total_tokens += int(input_token + output_token)
+    manifest_records.append(make_record(file_name, path, text, line_paths))
     
     # 返回原始文本而不实际翻译
     return text
 
+def tally_tokens(texts: List[str]):
+    """统计需要翻译的字符串数量与预估token（汇总各文件的提取结果后统一计算，与是否并行无关）"""
+    global translation_count, input_tokens, output_tokens, total_tokens
+
+    for text in texts:
+        translation_count += 1
+        
+        # 估算token数量 (日文和中文通常1字符≈1token)
+        input_token = len(text)
+        output_token = len(text) * 1.2  # 假设中文输出比日文长20%
+        input_tokens += input_token
+        output_tokens += output_token
+        total_tokens += int(input_token + output_token)
+
 # ========== 遍历 JSON 并统计 ==========
-def translate_japanese_in_obj(obj):
-    if isinstance(obj, dict):
-        return {k: translate_japanese_in_obj(v) for k, v in obj.items()}
-    elif isinstance(obj, list):
-        return [translate_japanese_in_obj(item) for item in obj]
-    elif isinstance(obj, str):
-        if JP_REGEX.search(obj):
-            return gpt_translate(obj)
-        return obj
-    else:
-        return obj
+def translate_japanese_in_obj(obj, file_name: str = "", rules: Optional[ExtractionRules] = None) -> int:
+    """
+    按遍历顺序记录含日文的字符串（只读遍历，不复制原结构）；
+    给定 rules 时只记录规则允许的字符串，返回被规则排除的条数
+    """
+    excluded = 0
+    merged_blocks = set()
+    for path, text in iter_strings(obj, JP_REGEX.search):
+        if rules is not None and not rules.accepts(file_name, path, obj):
+            excluded += 1
+            continue
+        block = message_block(obj, path) if MERGE_MESSAGE_LINES else None
+        if block is not None:
+            block_key, line_paths, lines = block
+            if block_key in merged_blocks:
+                continue
+            merged_blocks.add(block_key)
+            if len(lines) > 1:
+                # 整个对话框作为一条翻译，以第一行的位置作为ID
+                gpt_translate("\n".join(lines), file_name, line_paths[0], line_paths)
+                continue
+        gpt_translate(text, file_name, path)
+    return excluded
 
 # ========== 保存翻译字符串 ==========
 def save_translation_strings():
-    with open(OUTPUT_FILE, "w", encoding="utf-8") as f:
-        json.dump(strings_to_translate, f, ensure_ascii=False, indent=2)
-    print(f"\n已保存 {len(strings_to_translate)} 条需要翻译的字符串到 {OUTPUT_FILE}")
+    json_backend.dump_file(strings_to_translate, OUTPUT_FILE)
+    save_manifest(manifest_records, MANIFEST_FILE)
+    print(f"\n已保存 {len(strings_to_translate)} 条需要翻译的字符串到 {OUTPUT_FILE}，清单保存到 {MANIFEST_FILE}")
 
 # ========== 显示随机样本 ==========
 def show_samples():
@@ -92,9 +119,24 @@ def show_samples():
         print(f"\n【样本 {i}】")
         print(sample)
 
+# ========== 单文件提取 ==========
+def extract_file(file_path: Path, rules: Optional[ExtractionRules] = None) -> Tuple[list, list, int, Optional[str]]:
+    """提取单个文件中需要翻译的字符串，可在子进程中运行，返回 (字符串, 清单记录, 被规则排除的条数, 错误信息)"""
+    global strings_to_translate, manifest_records
+    strings_to_translate = []
+    manifest_records = []
+    excluded = 0
+    try:
+        content = json_backend.load_file(file_path)
+        # 只处理不保存
+        excluded = translate_japanese_in_obj(content, file_path.name, rules)
+    except Exception as e:
+        return strings_to_translate, manifest_records, excluded, f"[错误] 处理文件 {file_path}: {e}"
+    return strings_to_translate, manifest_records, excluded, None
+
 # ========== 主处理流程 ==========
-def process_all_json_files():
-    global translation_count, input_tokens, output_tokens, total_tokens, strings_to_translate
+def process_all_json_files(source_dir: Path = SOURCE_DIR, jobs: int = JOBS, use_rules: bool = USE_RULES):
+    global translation_count, input_tokens, output_tokens, total_tokens, strings_to_translate, manifest_records
 
     # 正确地使用 global 声明并重置
     translation_count = 0
@@ -102,16 +144,28 @@ def process_all_json_files():
     input_tokens = 0
     output_tokens = 0
     strings_to_translate = []
+    manifest_records = []
     
-    json_files = list(SOURCE_DIR.glob("*.json"))
-    for file_path in tqdm(json_files, desc="统计中"):
-        try:
-            with open(file_path, "r", encoding="utf-8") as f:
-                content = json.load(f)
-            # 只处理不保存
-            translate_japanese_in_obj(content)
-        except Exception as e:
-            print(f"[错误] 处理文件 {file_path}: {e}")
+    rules = load_rules(RULES_FILE) if use_rules else None
+    json_files = [p for p in source_dir.glob("*.json") if p.name not in EXCLUDED_FILES]
+    all_strings, all_records = [], []
+    total_excluded = 0
+    # 按文件列表顺序合并结果，并行与单进程的输出顺序和ID完全一致
+    if jobs > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            results = list(tqdm(executor.map(extract_file, json_files, repeat(rules)), total=len(json_files), desc="统计中"))
+    else:
+        results = (extract_file(file_path, rules) for file_path in tqdm(json_files, desc="统计中"))
+    for strings, records, excluded, error in results:
+        if error:
+            print(error)
+        all_strings.extend(strings)
+        all_records.extend(records)
+        total_excluded += excluded
+
+    strings_to_translate = all_strings
+    manifest_records = all_records
+    tally_tokens(strings_to_translate)
     
     # 保存和显示结果
     save_translation_strings()
@@ -119,16 +173,74 @@ def process_all_json_files():
     
     print(f"\n统计结果:")
     print(f"需要翻译的字符串数量: {translation_count}")
+    if rules is not None:
+        print(f"按提取规则排除的日文字符串（素材名、脚本、备注等）: {total_excluded}")
     print(f"预估总token消耗: {total_tokens}")
     print(f"输入token数量: {input_tokens}, 输出token数量: {output_tokens}")
     print(f"按v3价格估算费用: ${input_tokens / 1000 * 0.002 + output_tokens / 1000 * 0.008:.2f} (输入+输出)")
 
+# ========== 增量模式 ==========
+def sync_backup(source_dir: Path):
+    """将更新后的日文数据中内容有变化的文件同步到备份目录，写回时以备份目录为原文"""
+    BACKUP_DIR.mkdir(parents=True, exist_ok=True)
+    synced = 0
+    for file_path in source_dir.glob("*.json"):
+        target = BACKUP_DIR / file_path.name
+        if target.exists() and target.read_bytes() == file_path.read_bytes():
+            continue
+        shutil.copy2(file_path, target)
+        synced += 1
+    print(f"已同步 {synced} 个有变化的文件到 {BACKUP_DIR}")
+
+def process_diff(source_dir: Path, jobs: int = JOBS, use_rules: bool = USE_RULES):
+    """
+    与上一次写回的基线按 (文件+JSON Pointer, 原文哈希) 比对，
+    未变化的字符串直接复用译文，只有新增或修改的字符串交给 translate_v4.py 翻译
+    """
+    if not BASELINE_FILE.exists():
+        print(f"未找到基线文件 {BASELINE_FILE}，请先完整运行一次提取、翻译与写回")
+        return
+
+    if source_dir.resolve() != BACKUP_DIR.resolve():
+        sync_backup(source_dir)
+
+    process_all_json_files(source_dir, jobs, use_rules)
+    reuse, stats = compute_reuse(manifest_records, load_baseline(BASELINE_FILE), strings_to_translate)
+    json_backend.dump_file(reuse, REUSE_FILE)
+
+    pending = [text for text, reused in zip(strings_to_translate, reuse) if reused is None]
+    pending_input = sum(len(text) for text in pending)
+    print(f"\n增量比对结果 (基线: {BASELINE_FILE}):")
+    print(f"未变化: {stats['unchanged']}, 位置移动: {stats['moved']}, 上次未翻译: {stats['untranslated']}, "
+          f"已修改: {stats['changed']}, 新增: {stats['new']}, 已删除: {stats['removed']}")
+    print(f"需要翻译的字符串数量: {len(pending)}，预估总token消耗: {int(pending_input + pending_input * 1.2)}")
+    print(f"可复用的译文已保存到 {REUSE_FILE}，translate_v4.py 只会翻译其中为 null 的字符串")
+
 # ========== 启动 ==========
 def main():
+    parser = argparse.ArgumentParser(description="提取 www/data 中需要翻译的日文字符串")
+    parser.add_argument("--diff", action="store_true",
+                        help="增量模式：与上一次写回的基线比对，只翻译新增或修改的字符串")
+    parser.add_argument("--source", type=Path, default=BACKUP_DIR,
+                        help=f"增量模式下读取的日文数据目录（默认 {BACKUP_DIR}，其他目录中有变化的文件会同步到 {BACKUP_DIR}）")
+    parser.add_argument("--jobs", type=int, default=JOBS, help="并行处理文件的进程数（默认 %(default)s，即单进程）")
+    parser.add_argument("--all-strings", action="store_true",
+                        help=f"不使用提取规则，提取所有含日文的字符串（默认按 extraction_rules.py 与 {RULES_FILE} 提取）")
+    args = parser.parse_args()
+    use_rules = USE_RULES and not args.all_strings
+
+    if args.diff:
+        print("开始增量比对...")
+        process_diff(args.source, args.jobs, use_rules)
+        return
+
     print("开始备份...")
     backup_data_dir()
     print("开始统计需要翻译的内容...")
-    process_all_json_files()
+    process_all_json_files(jobs=args.jobs, use_rules=use_rules)
+    # 完整提取时所有字符串都需要翻译，清除旧的复用文件
+    if REUSE_FILE.exists():
+        REUSE_FILE.unlink()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
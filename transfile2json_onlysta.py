@@ -1,177 +1,197 @@
-import json
+import argparse
+import heapq
 from pathlib import Path
-import re
-from tqdm import tqdm
 import time
-import math
+import json_backend
+import transfile2json
+from extraction_rules import RULES_FILE, load_rules
+from usage_ledger import (PRICES, PRIOR_RATIOS, CALIBRATION_FILE, LEDGER_FILE, char_counts, calibrate, load_calibration,
+                          load_ledger)
 
 # ========== 配置 ==========
 INPUT_FILE = Path("translation_strings.json")
+DATA_DIR = Path("www/data")  # 未运行 transfile2json.py 时直接从游戏数据中统计
 OUTPUT_FILE = Path("translation_stats.json")  # 改为统计结果文件
-MODEL_NAME = "gpt-4"
-BATCH_SIZE = 100
 PRINT_SAMPLES = True  # 是否打印样本
 SAMPLE_SIZE = 5  # 打印的样本数量
 
-# ========== 价格参数 ==========
-INPUT_PRICE =0.002  # 输入价格 元/千tokens
-OUTPUT_PRICE = 0.008  # 输出价格 元/千tokens
-TOKENS_PER_SECOND = 1000  # 假设处理速度 (tokens/秒)
-
-# ========== 增强版正则表达式 ==========
-PATTERN = re.compile(
-    r"^(?P<prefix>-*[↓↑]?[　\s-]*)"  # 更灵活的前缀（允许箭头在前）
-    r"(?P<text>.*?)"  # 懒惰匹配所有字符作为文本部分
-    r"(?P<suffix>[　\s↑↓-]*)$"  # 后缀
-)
-
-class TranslationStats:
-    def __init__(self):
-        self.total_input_tokens = 0
-        self.total_output_tokens = 0
-        self.total_cost = 0.0
-        self.total_time = 0.0
-        self.translated_strings = []
-        
-    def add_batch(self, input_tokens, output_tokens, process_time):
-        self.total_input_tokens += input_tokens
-        self.total_output_tokens += output_tokens
-        self.total_cost += (input_tokens / 1000 * INPUT_PRICE) + (output_tokens / 1000 * OUTPUT_PRICE)
-        self.total_time += process_time
-        
-    def get_summary(self):
-        return {
-            "total_strings": len(self.translated_strings),
-            "total_input_tokens": self.total_input_tokens,
-            "total_output_tokens": self.total_output_tokens,
-            "estimated_cost": self.total_cost,
-            "estimated_time": self.total_time,
-            "cost_detail": f"输入: ¥{self.total_input_tokens / 1000 * INPUT_PRICE:.2f} + 输出: ¥{self.total_output_tokens / 1000 * OUTPUT_PRICE:.2f}",
-            "price_rates": f"输入: {INPUT_PRICE}元/千tokens, 输出: {OUTPUT_PRICE}元/千tokens"
-        }
+# ========== 校准参数 ==========
+# 没有 token_calibration.json 与用量账本时使用的默认值；运行一次 translate_v4.py 后
+# 用 python usage_ledger.py --calibrate 按实际用量拟合，估算会自动改用拟合结果
+DEFAULT_CALIBRATION = {
+    "input_ratios": PRIOR_RATIOS,
+    "output_ratios_by_source": PRIOR_RATIOS,
+    "latency": {"base_seconds": 3.0, "seconds_per_output_token": 0.03},
+}
+CACHE_BLOCK_TOKENS = 64  # DeepSeek 硬盘缓存的存储单位，不足一个单位的前缀部分不会命中
+
 
 def estimate_tokens(text):
-    """估算字符串的token数量（日文和中文通常1字符≈1token）"""
+    """translate_v4.pack_batches 打包时使用的保守估计（1字符≈1token）"""
     return max(len(text), 1)  # 至少1个token
 
-def extract_text_parts(texts: list) -> tuple[list, list]:
-    """改进的文本提取函数"""
-    extracted = []
-    structures = []
-    
-    for text in texts:
-        match = PATTERN.match(str(text))
-        if match:
-            prefix = match.group("prefix") or ""
-            text_part = match.group("text") or ""
-            suffix = match.group("suffix") or ""
-            
-            if text_part.strip() and not re.fullmatch(r"[\s　↑↓-]+", text_part):
-                extracted.append(text_part)
-                structures.append((prefix, suffix))
-            else:
-                extracted.append(text)
-                structures.append(None)
-        else:
-            extracted.append(text)
-            structures.append(None)
-    
-    return extracted, structures
-
-def simulate_translate(batch: list, stats: TranslationStats):
-    """模拟翻译过程并统计"""
-    combined = "\n=\n".join(str(text) for text in batch)
-    
-    # 估算输入输出token
-    input_tokens = estimate_tokens(combined)
-    output_tokens = int(input_tokens * 1.2)  # 假设输出比输入多20%
-    
-    # 模拟处理时间 (基于token数量)
-    process_time = (input_tokens + output_tokens) / TOKENS_PER_SECOND
-    
-    # 更新统计
-    stats.add_batch(input_tokens, output_tokens, process_time)
-    
-    # 模拟翻译结果 (原样返回但标记为已翻译)
-    return batch
-
-def batch_process(texts: list, stats: TranslationStats) -> list:
-    """批量处理函数"""
-    extracted_texts, structures = extract_text_parts(texts)
-    
-    translated = []
-    for i in tqdm(range(0, len(extracted_texts), BATCH_SIZE), desc="模拟进度"):
-        batch = extracted_texts[i:i+BATCH_SIZE]
-        translated_batch = simulate_translate(batch, stats)
-        translated.extend(translated_batch)
-    
-    # 确保数量一致
-    translated = translated[:len(extracted_texts)]
-    
-    # 重建结构
-    final_result = []
-    for text, structure in zip(translated, structures):
-        if structure and isinstance(text, str):
-            prefix, suffix = structure
-            final_result.append(f"{prefix}{text}{suffix}")
-        else:
-            final_result.append(text)
-    
-    stats.translated_strings = final_result
-    return final_result
-
-def print_samples(stats: TranslationStats):
-    """打印样本"""
-    if not PRINT_SAMPLES or len(stats.translated_strings) == 0:
+def count_tokens(text: str, ratios: dict) -> float:
+    """按字符类别的 token/字符 比例估算token数"""
+    return sum(ratios.get(name, 1.0) * count for name, count in char_counts(text).items())
+
+def load_strings_from_data(data_dir: Path) -> list:
+    """遍历游戏数据目录，按 transfile2json.extract_file 提取字符串（提取规则、401 行合并与顺序均与真实运行一致）"""
+    rules = load_rules(RULES_FILE) if transfile2json.USE_RULES else None
+    strings = []
+    for file_path in data_dir.glob("*.json"):
+        if file_path.name in transfile2json.EXCLUDED_FILES:
+            continue
+        file_strings, _, _, error = transfile2json.extract_file(file_path, rules)
+        if error:
+            print(error)
+        strings.extend(file_strings)
+    return strings
+
+def resolve_calibration(ledger_files: list) -> tuple:
+    """依次使用 --ledger 指定的账本、token_calibration.json、默认账本，都没有时使用默认值；返回 (参数, 来源)"""
+    if ledger_files:
+        return calibrate(list(load_ledger(ledger_files))), ", ".join(map(str, ledger_files))
+    calibration = load_calibration(CALIBRATION_FILE)
+    if calibration is not None:
+        return calibration, str(CALIBRATION_FILE)
+    if LEDGER_FILE.exists():
+        return calibrate(list(load_ledger([LEDGER_FILE]))), str(LEDGER_FILE)
+    return DEFAULT_CALIBRATION, "默认值（未校准）"
+
+def build_requests(texts: list) -> tuple:
+    """
+    按 translate_v4.py 的实际流程生成请求：去重、拆分前后缀、控制符占位、按 token 预算打包，
+    每个批次按 safe_combine_texts 的编号格式与 PromptBuilder 的消息结构（系统提示词、术语表、示例）组装。
+    返回 (每个请求的消息列表, 固定前缀消息, 发送的唯一文本数)
+    """
+    # translate_v4 在模块顶层导入本模块的 estimate_tokens，这里延迟导入避免循环导入
+    import translate_v4 as tv
+    from control_codes import mask_texts
+    from glossary import GLOSSARY_FILE, Glossary, load_glossary
+
+    work_texts = tv.dedup_texts(texts)[0] if tv.DEDUP else texts
+    extracted, _ = tv.extract_text_parts(work_texts)
+    if tv.MASK_CONTROL_CODES:
+        extracted, _ = mask_texts(extracted)
+    distinct = list(dict.fromkeys(extracted))
+
+    entries = load_glossary(GLOSSARY_FILE) if tv.USE_GLOSSARY else {}
+    builder = tv.PromptBuilder(tv.SYSTEM_PROMPT, Glossary(entries) if entries else None)
+    requests = []
+    for indices in tv.pack_batches(distinct):
+        batch = [distinct[i] for i in indices]
+        requests.append(builder.build(batch, tv.safe_combine_texts(batch)))
+    return requests, builder.prefix, len(distinct)
+
+def simulate_wall_time(latencies: list, concurrency: int) -> float:
+    """模拟 concurrency 个 worker 按顺序领取共享队列中的批次，返回全部完成的时间"""
+    workers = [0.0] * min(concurrency, len(latencies))
+    for latency in latencies:
+        heapq.heappush(workers, heapq.heappop(workers) + latency)
+    return max(workers, default=0.0)
+
+def estimate(texts: list, calibration: dict, concurrency: int) -> dict:
+    requests, prefix, distinct_count = build_requests(texts)
+    input_ratios = calibration["input_ratios"]
+    output_ratios = calibration.get("output_ratios_by_source") or DEFAULT_CALIBRATION["output_ratios_by_source"]
+    latency = calibration.get("latency") or DEFAULT_CALIBRATION["latency"]
+
+    # 固定前缀在第一个请求之后按缓存计费（按缓存单位向下取整）
+    prefix_tokens = sum(count_tokens(m["content"], input_ratios) for m in prefix)
+    cached_prefix = prefix_tokens // CACHE_BLOCK_TOKENS * CACHE_BLOCK_TOKENS
+
+    input_tokens = hit_tokens = output_tokens = 0.0
+    latencies = []
+    for i, messages in enumerate(requests):
+        request_input = sum(count_tokens(m["content"], input_ratios) for m in messages)
+        request_output = count_tokens(messages[-1]["content"], output_ratios)
+        input_tokens += request_input
+        hit_tokens += cached_prefix if i else 0
+        output_tokens += request_output
+        latencies.append(latency["base_seconds"] + latency["seconds_per_output_token"] * request_output)
+
+    miss_tokens = input_tokens - hit_tokens
+    costs = {tier: (hit_tokens * p["cache_hit"] + miss_tokens * p["cache_miss"] + output_tokens * p["output"]) / 1000
+             for tier, p in PRICES.items()}
+    return {
+        "total_strings": len(texts),
+        "distinct_strings": distinct_count,
+        "dedup_ratio": 1 - distinct_count / len(texts) if texts else 0.0,
+        "requests": len(requests),
+        "prefix_tokens": round(prefix_tokens),
+        "input_tokens": round(input_tokens),
+        "cache_hit_tokens": round(hit_tokens),
+        "output_tokens": round(output_tokens),
+        "cost_standard": costs["standard"],
+        "cost_offpeak": costs["offpeak"],
+        "concurrency": concurrency,
+        "wall_time": simulate_wall_time(latencies, concurrency),
+        "price_rates": {tier: f"缓存命中 {p['cache_hit']} / 未命中 {p['cache_miss']} / 输出 {p['output']} 元/千tokens"
+                        for tier, p in PRICES.items()},
+        "sample_prompt": requests[0][-1]["content"] if requests else "",
+    }
+
+def print_samples(result: dict):
+    """打印第一个请求的用户消息，确认编号格式"""
+    if not PRINT_SAMPLES or not result["sample_prompt"]:
         return
-        
-    print("\n随机样本:")
-    samples = stats.translated_strings[:SAMPLE_SIZE]
-    for i, sample in enumerate(samples, 1):
-        print(f"[样本 {i}] {sample}")
+
+    print("\n第一个请求的待翻译部分:")
+    lines = result["sample_prompt"].split("\n")
+    for line in lines[:SAMPLE_SIZE + 1]:
+        print(f"  {line}")
+    if len(lines) > SAMPLE_SIZE + 1:
+        print(f"  ...（共 {len(lines)} 行）")
 
 def main():
+    import translate_v4 as tv  # 默认并发数与 translate_v4.py 一致
+    parser = argparse.ArgumentParser(description="按 translate_v4.py 的实际请求格式估算token用量、费用与耗时")
+    parser.add_argument("--concurrency", type=int, default=tv.CONCURRENCY, help="估算耗时使用的并发请求数（默认 %(default)s）")
+    parser.add_argument("--ledger", nargs="*", type=Path, default=[], help="直接用这些用量账本校准（默认读取 token_calibration.json）")
+    args = parser.parse_args()
+
     # 验证输入文件
-    if not INPUT_FILE.exists():
-        print(f"错误: 输入文件不存在 {INPUT_FILE}")
+    if not INPUT_FILE.exists() and not DATA_DIR.exists():
+        print(f"错误: 输入文件 {INPUT_FILE} 与数据目录 {DATA_DIR} 均不存在")
         return
-    
+
     # 读取日文字符串
     try:
-        with open(INPUT_FILE, "r", encoding="utf-8") as f:
-            japanese_strings = json.load(f)
+        if INPUT_FILE.exists():
+            japanese_strings = json_backend.load_file(INPUT_FILE)
+        else:
+            print(f"未找到 {INPUT_FILE}，直接统计 {DATA_DIR} 中的日文字符串")
+            japanese_strings = load_strings_from_data(DATA_DIR)
     except Exception as e:
         print(f"读取输入文件失败: {e}")
         return
-    
-    print(f"开始模拟翻译 {len(japanese_strings)} 条字符串...")
+
+    calibration, source = resolve_calibration(args.ledger)
+    print(f"开始估算 {len(japanese_strings)} 条字符串... (校准参数: {source})")
     start_time = time.time()
-    
-    stats = TranslationStats()
-    batch_process(japanese_strings, stats)
-    
-    total_real_time = time.time() - start_time
-    stats.total_time = max(stats.total_time, total_real_time)  # 取计算时间和实际时间的较大值
-    
+    result = estimate(japanese_strings, calibration, args.concurrency)
+    result["calibration"] = source
+
     # 保存统计结果
-    result = stats.get_summary()
     try:
-        with open(OUTPUT_FILE, "w", encoding="utf-8") as f:
-            json.dump(result, f, ensure_ascii=False, indent=2)
+        json_backend.dump_file(result, OUTPUT_FILE)
         print(f"\n统计结果已保存到: {OUTPUT_FILE}")
     except Exception as e:
         print(f"保存统计结果失败: {e}")
-    
+
     # 打印统计
     print("\n===== 统计摘要 =====")
-    print(f"总字符串数: {result['total_strings']}")
-    print(f"总输入token: {result['total_input_tokens']}")
-    print(f"总输出token: {result['total_output_tokens']}")
-    print(f"预估费用: ¥{result['estimated_cost']:.2f} ({result['cost_detail']})")
-    print(f"预估时间: {result['estimated_time']:.2f}秒")
-    print(f"价格费率: {result['price_rates']}")
-    
-    print_samples(stats)
+    print(f"总字符串数: {result['total_strings']}（去重后 {result['distinct_strings']} 条, 去重率 {result['dedup_ratio']:.1%}）")
+    print(f"请求数: {result['requests']}（固定前缀约 {result['prefix_tokens']} tokens）")
+    print(f"总输入token: {result['input_tokens']}（其中缓存命中约 {result['cache_hit_tokens']}）")
+    print(f"总输出token: {result['output_tokens']}")
+    print(f"预估费用: 标准价 ¥{result['cost_standard']:.2f}, 错峰时段 ¥{result['cost_offpeak']:.2f}")
+    print(f"预估时间: {result['wall_time']:.0f}秒（{result['concurrency']} 个并发请求，不含限流与重试）")
+    for tier, rates in result["price_rates"].items():
+        print(f"价格费率({tier}): {rates}")
+    print(f"计算耗时: {time.time() - start_time:.2f}秒")
+
+    print_samples(result)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
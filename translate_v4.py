@@ -1,28 +1,72 @@
 import json
 from pathlib import Path
 import openai
-from openai import OpenAI
+from openai import AsyncOpenAI
 import os
 import re
 from tqdm import tqdm
-import threading
-import queue
+import asyncio
 import time
-import math
 from typing import List, Tuple, Dict, Optional
 import glob
+from translation_memory import TranslationMemory, TM_FILE
+from checkpoint_journal import CheckpointJournal, batch_hash
+from transfile2json_onlysta import estimate_tokens
+from concurrency import AdaptiveLimiter, is_throttle_error, retry_after_seconds, backoff_delay
+from string_manifest import MANIFEST_FILE, REUSE_FILE, STATUS_FILE, load_manifest
+from control_codes import mask_text, mask_texts, placeholders_match, unmask_text
+from glossary import Glossary, GLOSSARY_FILE, collect_terms, load_glossary, save_glossary
+from prompt_cache import PromptBuilder, CacheStats
+from usage_ledger import UsageLedger, LEDGER_FILE, current_worker
+import json_backend
 
 # ========== 配置 ==========
 INPUT_FILE = Path("translation_strings.json")
 OUTPUT_DIR = Path("json_temp")
-THREAD_COUNT = 8  # 线程数
-BATCH_SIZE = 50   # 每批处理量
-SAVE_EVERY = 10    # 每处理多少批次保存一次
-MAX_RETRIES = 3    # 最大重试次数
+JOURNAL_FILE = OUTPUT_DIR / "journal.jsonl"  # 追加写入的检查点日志，每完成一个批次写一行
+CONCURRENCY = 64  # 初始同时在途的API请求数（单进程协程，不再一线程一请求）
+MIN_CONCURRENCY = 4     # 自适应并发的下限
+MAX_CONCURRENCY = 200   # 自适应并发的上限（也是 worker 协程数）
+TARGET_LATENCY = 90.0   # 平均单批延迟低于该秒数时才继续增加并发
+MAX_BATCH_INPUT_TOKENS = 2000   # 单个请求的预估输入token上限
+MAX_BATCH_OUTPUT_TOKENS = 3000  # 单个请求的预估输出token上限（需低于模型输出上限，避免截断）
+MAX_OUTPUT_TOKENS = 8192        # 请求的 max_tokens；输出被截断时只重新提交未完成的部分
+MAX_BATCH_ITEMS = 100           # 单个请求的最大条数
+OUTPUT_TOKEN_RATIO = 1.2        # 打包时预估的输出token/输入token（偏保守，避免输出被截断）
+LENGTH_BUCKETING = False        # 按长度分桶打包，使各批耗时接近（会打乱相邻对话的上下文）
+MAX_RETRIES = 3    # 最大重试次数（普通错误）
+STREAM_MAX_PREFACE_CHARS = 200  # 流式输出中第一行编号之前允许的说明文字长度，超出则提前中止
+STREAM_EXTRA_LINES = 2          # 多行原文的译文允许多出的行数，超出视为模型在输出解释，提前中止（单行原文不允许多出）
+LINE_RETRIES = 2   # 漏行或未翻译的行单独重试的轮数
+MAX_THROTTLE_RETRIES = 10  # 429/5xx 限流时的最大重试次数，退避后重试，不计入 MAX_RETRIES
+METRICS_FILE = OUTPUT_DIR / "metrics.json"  # 当前并发数等运行指标
+USE_TM = True      # 是否使用翻译记忆库（见 translation_memory.py）
+DEDUP = True       # 翻译前按提取后的文本去重
+USE_GLOSSARY = True  # 从数据库文件生成术语表，每个批次只注入其中出现的术语（见 glossary.py）
+GLOSSARY_DATA_DIRS = [Path("www/data_bak"), Path("www/data")]  # 读取术语的目录，取第一个存在的
+MASK_CONTROL_CODES = True  # 将 \C[n]、\N[n] 等控制符替换为 {1} 形式的占位符后再翻译（见 control_codes.py）
+RECORD_USAGE = True  # 将每个请求的真实用量追加到 LEDGER_FILE（见 usage_ledger.py）
 DEBUG = True
 
+# ========== 模型与提示词 ==========
+MODEL_NAME = "deepseek-chat"
+PROMPT_VERSION = "v4-numbered-4"  # 修改 SYSTEM_PROMPT 后需同步修改，避免复用旧提示词的记忆
+SYSTEM_PROMPT = (
+    "你是一个专业的日文翻译助手。请逐条翻译日文为中文，保留行号和顺序。"
+    "原文为编号形式（如 1. xxx），你只需将每行的文本部分翻译为中文，编号保持不变。"
+    "如果某行无法翻译，请原样保留。"
+    "同一编号的原文包含多行时（同一个对话框），译文也按原来的行数分行输出。"
+    "{1}、{2} 等占位符是游戏控制符，必须原样保留在译文的对应位置，不得增删或修改。"
+)
+
 # ========== 初始化Client ==========
-client = OpenAI(api_key="<API KEY>", base_url="https://api.deepseek.com")
+# 关闭SDK内置重试，429/5xx 交给 AdaptiveLimiter 处理
+client = AsyncOpenAI(api_key="<API KEY>", base_url="https://api.deepseek.com", max_retries=0)
+translation_memory: Optional[TranslationMemory] = None  # 在 main 中打开
+glossary: Optional[Glossary] = None  # 在 main 中生成
+prompt_builder = PromptBuilder(SYSTEM_PROMPT)  # 生成术语表后在 main 中替换
+cache_stats = CacheStats()
+usage_ledger: Optional[UsageLedger] = None  # 在 main 中打开
 
 # ========== 正则表达式 ==========
 PATTERN = re.compile(
@@ -30,61 +74,167 @@ PATTERN = re.compile(
     r"(?P<text>.*?)"
     r"(?P<suffix>[　\s↑↓-]*)$"
 )
+NUMBERED_LINE = re.compile(r"^(\d+)\.(?:\s+|$)(.*)$")
+KANA_REGEX = re.compile(r'[\u3041-\u3096\u30a1-\u30fa]')  # 平假名/片假名（不含长音符与中点）
 
-def split_json(input_file: Path, parts: int) -> List[List[dict]]:
-    """将原始JSON文件拆分为多个部分"""
-    with open(input_file, 'r', encoding='utf-8') as f:
-        data = json.load(f)
-    
-    part_size = math.ceil(len(data) / parts)
-    return [data[i*part_size : (i+1)*part_size] for i in range(parts)]
+def load_source_texts(input_file: Path) -> List[str]:
+    """读取提取出的原始字符串列表"""
+    return json_backend.load_file(input_file)
 
-SEPARATOR = "|||"
+def load_reuse(reuse_file: Path, count: int) -> Optional[List[Optional[str]]]:
+    """读取增量模式（transfile2json.py --diff）生成的可复用译文，条数与输入不一致时忽略"""
+    if not reuse_file.exists():
+        return None
+    reuse = json_backend.load_file(reuse_file)
+    if len(reuse) != count:
+        print(f"\033[1;31m{reuse_file} 条数 ({len(reuse)}) 与输入 ({count}) 不一致，忽略增量复用\033[0m")
+        return None
+    return reuse
 
-# def safe_combine_texts(texts: List[str]) -> str:
-#     """安全合并文本列表"""
-#     for text in texts:
-#         if SEPARATOR in text:
-#             text = text.replace(SEPARATOR, "∣")
-#     return SEPARATOR.join(texts)
+def load_source_files(count: int) -> Optional[List[str]]:
+    """读取清单中每条字符串所在的文件，用于按文件统计费用；清单不存在或条数不一致时返回 None"""
+    if not MANIFEST_FILE.exists():
+        return None
+    files = [record["file"] for record in load_manifest(MANIFEST_FILE)]
+    return files if len(files) == count else None
+
+def dedup_texts(texts: List[str]) -> Tuple[List[str], List[int], List[tuple]]:
+    """
+    按 PATTERN 拆分前后缀后的文本去重。
+    返回 (唯一文本列表, 每个原始位置对应的唯一文本下标, 每个原始位置的前后缀结构)
+    """
+    extracted, structures = extract_text_parts(texts)
+    unique_texts = []
+    unique_index = {}
+    positions = []
+    for text in extracted:
+        idx = unique_index.get(text)
+        if idx is None:
+            idx = len(unique_texts)
+            unique_index[text] = idx
+            unique_texts.append(text)
+        positions.append(idx)
+    return unique_texts, positions, structures
+
+def expand_dedup_results(translated_unique: List[str], unique_texts: List[str],
+                         positions: List[int], structures: List[tuple]) -> List[str]:
+    """将唯一文本的翻译结果展开回完整的按位置排列的列表（缺失的结果保留原文）"""
+    expanded = []
+    for idx in positions:
+        expanded.append(translated_unique[idx] if idx < len(translated_unique) else unique_texts[idx])
+    return reconstruct_translated_texts(expanded, structures)
 
 def safe_combine_texts(texts: List[str]) -> str:
     return "\n".join([f"{i+1}. {t}" for i, t in enumerate(texts)])
 
-# def safe_split_result(result: str, expected_count: int) -> List[str]:
-#     """安全拆分翻译结果"""
-#     parts = [p.strip() for p in result.split(SEPARATOR) if p.strip()]
-    
-#     if len(parts) != expected_count:
-#         parts = [p for p in parts 
-#                 if not p.startswith("=") and not p.startswith("「") 
-#                 and len(p) > 1]
-#     return parts
+def count_lines(text: str) -> int:
+    """非空行数"""
+    return sum(1 for line in text.split("\n") if line.strip())
 
-def safe_split_result(result: str, expected_count: int) -> List[str]:
+def find_bad_lines(batch: List[str], lines: Dict[int, str]) -> List[int]:
     """
-    根据编号（如 1. xxx\n2. yyy）来提取翻译结果，避免因换行错误分割。
+    找出缺失的行、原文含假名但译文仍含假名（未翻译）的行、占位符被改动的行，
+    以及行数多于原文（模型附加了解释）的行，返回批次内下标
     """
-    # 匹配以数字编号开头的段落（可能跨多行）
-    pattern = re.compile(r"^\d+\.\s", re.MULTILINE)
-    positions = [m.start() for m in pattern.finditer(result)]
-
-    translated = []
-
-    for i in range(len(positions)):
-        start = positions[i]
-        end = positions[i + 1] if i + 1 < len(positions) else len(result)
-        block = result[start:end].strip()
+    bad = []
+    for i, text in enumerate(batch):
+        translated = lines.get(i + 1)
+        if translated is None or (KANA_REGEX.search(text) and KANA_REGEX.search(translated)) \
+                or not placeholders_match(text, translated) or count_lines(translated) > count_lines(text):
+            bad.append(i)
+    return bad
 
-        # 去掉前缀编号 “1.”、“2.”等
-        match = re.match(r"^\d+\.\s*(.*)", block, re.DOTALL)
+class NumberedLineStream:
+    """
+    增量解析流式输出中的 "N. 文本" 行。某一条在下一条编号出现（或输出正常结束）时视为完成；
+    编号回退/越界、编号前说明过长或单条多出过多行时设置 aborted，调用方应中止流。
+    """
+    
+    def __init__(self, batch: List[str]):
+        self.batch = batch
+        self.buffer = ""
+        self.current: Optional[Tuple[int, List[str]]] = None
+        self.preface_chars = 0
+        self.aborted: Optional[str] = None
+    
+    def feed(self, text: str) -> List[Tuple[int, str]]:
+        """输入一段增量文本，返回新完成的 (编号, 译文)"""
+        self.buffer += text
+        completed = []
+        while "\n" in self.buffer and not self.aborted:
+            line, self.buffer = self.buffer.split("\n", 1)
+            completed.extend(self._process_line(line))
+        return completed
+    
+    def finish(self, complete: bool) -> List[Tuple[int, str]]:
+        """流结束时调用；complete 为 False（输出被截断）时丢弃最后一条未完成的内容"""
+        if self.aborted:
+            return []
+        if not complete:
+            # 截断处已经开始输出下一条的编号，说明当前这一条是完整的
+            if self.current is not None and re.match(r"^\d+\.", self.buffer.strip()):
+                return self._flush()
+            return []
+        completed = self._process_line(self.buffer) if self.buffer else []
+        self.buffer = ""
+        if not self.aborted and self.current is not None:
+            completed.extend(self._flush())
+        return completed
+    
+    def _flush(self) -> List[Tuple[int, str]]:
+        number, lines = self.current
+        self.current = None
+        return [(number, "\n".join(lines).strip())]
+    
+    def _process_line(self, line: str) -> List[Tuple[int, str]]:
+        match = NUMBERED_LINE.match(line.strip())
         if match:
-            translated.append(match.group(1).strip())
-        else:
-            translated.append(block.strip())
+            number = int(match.group(1))
+            last = self.current[0] if self.current else 0
+            if number <= last or number > len(self.batch):
+                # 新的编号行出现，说明当前这一条已经完整，中止前先提交
+                completed = self._flush() if self.current is not None else []
+                self.aborted = f"编号异常（{last} 之后出现 {number}）"
+                return completed
+            completed = self._flush() if self.current is not None else []
+            self.current = (number, [match.group(2)])
+            return completed
+        
+        if self.current is None:
+            self.preface_chars += len(line)
+            if self.preface_chars > STREAM_MAX_PREFACE_CHARS:
+                self.aborted = "编号前出现过长的说明文字"
+            return []
+        
+        number, lines = self.current
+        lines.append(line)
+        source_lines = count_lines(self.batch[number - 1])
+        # 单行原文出现第二行即视为解释；多行原文允许少量偏差，多出的行由 find_bad_lines 检出后重试
+        extra_lines = STREAM_EXTRA_LINES if source_lines > 1 else 0
+        if sum(1 for l in lines if l.strip()) > source_lines + extra_lines:
+            self.aborted = f"第 {number} 条后出现多余的内容"
+        return []
 
-    # 校验数量并自动修复（补空或截断）
-    return validate_and_fix_batch(translated, [''] * expected_count)
+def is_valid_translation(source: str, translated: str) -> bool:
+    """
+    判断模型实际返回的译文：空结果、原文含假名而译文仍含假名、占位符被改动或行数多于原文的译文视为无效；
+    纯汉字原文（如「勇者」）的正确译文可能与原文相同，视为有效。翻译失败时保留的原文不经此判断
+    """
+    if not translated.strip():
+        return False
+    if KANA_REGEX.search(source) and KANA_REGEX.search(translated):
+        return False
+    if count_lines(translated) > count_lines(source):
+        return False
+    return placeholders_match(source, translated)
+
+async def commit_lines(batch: List[str], lines: Dict[int, str]):
+    """将一次响应中完成的有效译文一次性写入翻译记忆库（无效的译文不写入）"""
+    if translation_memory is None:
+        return
+    valid = [number for number, text in lines.items() if is_valid_translation(batch[number - 1], text)]
+    if valid:
+        await translation_memory.store_async([batch[n - 1] for n in valid], [lines[n] for n in valid])
 
 def extract_text_parts(texts: List[str]) -> Tuple[List[str], List[tuple]]:
     """提取需要翻译的文本部分"""
@@ -110,199 +260,363 @@ def extract_text_parts(texts: List[str]) -> Tuple[List[str], List[tuple]]:
     
     return extracted, structures
 
-def reconstruct_translated_texts(translated: List[str], structures: List[tuple]) -> List[str]:
-    """重建翻译后的字符串"""
+def reconstruct_translated_texts(translated: List[str], structures: List[tuple],
+                                 masked_sources: Optional[List[str]] = None,
+                                 codes: Optional[List[Optional[List[str]]]] = None,
+                                 originals: Optional[List[str]] = None) -> List[str]:
+    """
+    重建翻译后的字符串。给定 codes 时先将占位符还原为控制符：
+    占位符与 masked_sources 中的原文不一致的条目改用 originals 中未翻译的原文，避免写入损坏的控制符
+    """
     reconstructed = []
-    for text, structure in zip(translated, structures):
+    broken = 0
+    for i, (text, structure) in enumerate(zip(translated, structures)):
+        if codes is not None and isinstance(text, str):
+            if placeholders_match(masked_sources[i], text):
+                text = unmask_text(text, codes[i])
+            else:
+                text = originals[i]
+                broken += 1
         if structure and isinstance(text, str):
             prefix, suffix = structure
             reconstructed.append(f"{prefix}{text}{suffix}")
         else:
             reconstructed.append(text)
+    if broken:
+        print(f"\033[1;31m{broken} 条译文的控制符占位符不完整，已保留原文\033[0m")
     return reconstructed
 
-def load_existing_result(thread_id: int, save_count: int) -> Optional[List[str]]:
-    """检查并加载已存在的翻译结果"""
-    output_file = OUTPUT_DIR / f"{thread_id}_{save_count}_translated.json"
-    if not output_file.exists():
-        return None
-    
-    try:
-        with open(output_file, 'r', encoding='utf-8') as f:
-            existing_data = json.load(f)
-        return existing_data
-    except:
-        return None
-
-def validate_and_fix_batch(translated_batch: List[str], original_batch: List[str]) -> List[str]:
-    """验证并修复翻译结果长度"""
-    if len(translated_batch) > len(original_batch):
-        return translated_batch[:len(original_batch)]
-    elif len(translated_batch) < len(original_batch):
-        return translated_batch + original_batch[len(translated_batch):]
-    return translated_batch
-
-def save_partial_result(thread_id: int, save_count: int, translated_data: List[str], original_data: List[str]):
-    """保存每SAVE_EVERY批次的结果和原文"""
-    OUTPUT_DIR.mkdir(exist_ok=True)
-    
-    # 保存翻译结果
-    translated_file = OUTPUT_DIR / f"{thread_id}_{save_count}_translated.json"
-    with open(translated_file, 'w', encoding='utf-8') as f:
-        json.dump(translated_data, f, ensure_ascii=False, indent=2)
+async def request_translation(batch_id: str, batch: List[str], pbar, limiter: AdaptiveLimiter,
+                              line_retry: int = 0) -> Tuple[List[str], List[bool]]:
+    """
+    以流式方式调用API翻译一个批次，响应结束（或中途断开）后将已完成的行写入翻译记忆库；
+    返回 (翻译结果, 每条是否由模型返回了有效译文)，未返回的条目保留原文。
+    """
+    messages = prompt_builder.build(batch, safe_combine_texts(batch))
     
-    # 保存原文对照
-    original_file = OUTPUT_DIR / f"{thread_id}_{save_count}_original.json"
-    with open(original_file, 'w', encoding='utf-8') as f:
-        json.dump(original_data, f, ensure_ascii=False, indent=2)
+    errors = 0
+    throttles = 0
+    while True:
+        lines: Dict[int, str] = {}
+        parser = NumberedLineStream(batch)
+        output = []
+        finish_reason = None
+        usage = None
+        try:
+            async with limiter.slot():
+                started = time.monotonic()
+                stream = await client.chat.completions.create(
+                    model=MODEL_NAME,
+                    messages=messages,
+                    max_tokens=MAX_OUTPUT_TOKENS,
+                    stream=True,
+                    stream_options={"include_usage": True},
+                )
+                async for chunk in stream:
+                    if chunk.usage:
+                        usage = chunk.usage
+                    if not chunk.choices:
+                        continue
+                    choice = chunk.choices[0]
+                    if choice.delta.content:
+                        output.append(choice.delta.content)
+                        for number, text in parser.feed(choice.delta.content):
+                            lines[number] = text
+                        if parser.aborted:
+                            # 模型开始输出无关内容，立即停止接收，避免为无用的输出付费
+                            await stream.close()
+                            break
+                    if choice.finish_reason:
+                        finish_reason = choice.finish_reason
+                latency = time.monotonic() - started
+                limiter.on_success(latency)
+            cache_stats.record(batch_id, usage)
+            if usage_ledger is not None:
+                usage_ledger.record(batch_id, batch, messages, "".join(output), usage, latency,
+                                    errors + throttles, line_retry, finish_reason)
+            
+            # 只有 "stop" 表示输出完整；"length"、"insufficient_system_resource"、"content_filter"
+            # 或没有 finish_reason 就结束的流，最后一条都可能不完整
+            for number, text in parser.finish(finish_reason == "stop"):
+                lines[number] = text
+            if parser.aborted:
+                pbar.write(f"[批次 {batch_id}] 提前中止流式输出: {parser.aborted}（已完成 {len(lines)}/{len(batch)} 行）")
+            break
+            
+        except Exception as e:
+            # 流在中途断开时同样反馈给并发控制：负载高时的 5xx 与断连多发生在输出过程中
+            throttled = is_throttle_error(e)
+            if throttled:
+                limiter.on_throttle()
+            else:
+                limiter.on_error()
+            if lines:
+                # 流在中途断开：已完成的行保留，剩余部分按截断处理
+                pbar.write(f"[批次 {batch_id}] 流式输出中断: {str(e)}（已完成 {len(lines)}/{len(batch)} 行）")
+                if usage_ledger is not None:
+                    usage_ledger.record(batch_id, batch, messages, "".join(output), usage, time.monotonic() - started,
+                                        errors + throttles, line_retry, "error")
+                finish_reason = "error"
+                break
+            if throttled:
+                throttles += 1
+                if throttles > MAX_THROTTLE_RETRIES:
+                    return batch, [False] * len(batch)  # 失败时保留原文
+            else:
+                errors += 1
+                if errors >= MAX_RETRIES:
+                    return batch, [False] * len(batch)
+            delay = backoff_delay(errors + throttles, retry_after_seconds(e))
+            pbar.write(f"[批次 {batch_id}] 出错: {str(e)}，{delay:.1f}秒后重试 (当前并发上限 {limiter.limit})")
+            await asyncio.sleep(delay)
     
-    if DEBUG:
-        print(f"\n\033[1;33m[线程 {thread_id}] 已保存第 {save_count} 次结果 → {translated_file}\033[0m")
-        print(f"\033[1;33m[线程 {thread_id}] 已保存第 {save_count} 次原文 → {original_file}\033[0m")
-
-def batch_translate(thread_id: int, texts: List[str]):
-    """线程处理函数 - 改进的缓存跳过逻辑"""
-    extracted_texts, structures = extract_text_parts(texts)
-    batch_count = 0
-    save_count = 0
-    accumulated_translated = []
-    accumulated_original = []
+    await commit_lines(batch, lines)
+    # 提前中止是模型输出了多余内容，按漏行重试；其余非正常结束按截断处理，只重新提交未完成的部分
+    truncated = not parser.aborted and finish_reason != "stop"
+    return await resolve_response(batch_id, batch, lines, truncated, usage, pbar, limiter, line_retry)
+
+async def resolve_response(batch_id: str, batch: List[str], lines: Dict[int, str], truncated: bool, usage,
+                           pbar, limiter: AdaptiveLimiter, line_retry: int) -> Tuple[List[str], List[bool]]:
+    """
+    逐行校验已完成的译文（lines 为 {编号: 译文}），只将有问题的行组成小批次重新提交：
+    - 输出被截断（finish_reason 不是 "stop"，包括流中途断开）时保留已完整输出的行，只重新提交剩余部分，
+      一行都没有完成时将剩余部分对半拆分后分别提交；
+    - 漏行、仍含假名或因提前中止而缺失的行最多单独重试 LINE_RETRIES 轮，仍失败时保留原文。
+    返回的标记记录每条是否由模型返回了有效译文，batch_worker 只将这些行写入检查点日志，其余下次运行时重试；
+    保留的原文不按内容判断（纯汉字原文的正确译文也可能与原文相同）。
+    """
+    translated = [lines.get(i + 1, text) for i, text in enumerate(batch)]
+    bad = find_bad_lines(batch, lines)
+    produced = [True] * len(batch)
+    for i in bad:
+        produced[i] = False
+    if not bad:
+        return translated, produced
     
-    # 计算总批次数
-    total_batches = (len(extracted_texts) + BATCH_SIZE - 1) // BATCH_SIZE
+    if truncated:
+        output_tokens = getattr(usage, "completion_tokens", None)
+        pbar.write(f"[批次 {batch_id}] 输出被截断（{len(batch) - len(bad)}/{len(batch)} 行完整"
+                   f"{f', 输出 {output_tokens} tokens' if output_tokens else ''}），重新提交剩余 {len(bad)} 条")
+        if len(bad) == len(batch):
+            if len(batch) == 1:
+                return translated, produced  # 单条仍被截断，保留原文
+            mid = len(batch) // 2
+            (left, left_produced), (right, right_produced) = await asyncio.gather(
+                request_translation(batch_id, batch[:mid], pbar, limiter, line_retry),
+                request_translation(batch_id, batch[mid:], pbar, limiter, line_retry),
+            )
+            return left + right, left_produced + right_produced
+    elif line_retry >= LINE_RETRIES:
+        return translated, produced
+    else:
+        pbar.write(f"[批次 {batch_id}] {len(bad)}/{len(batch)} 行漏译或未翻译，单独重试这些行")
+        line_retry += 1
     
-    # 创建批次处理状态表
-    batch_status = [False] * total_batches  # False表示未处理，True表示已处理或跳过
+    retried, retried_produced = await request_translation(batch_id, [batch[i] for i in bad], pbar, limiter, line_retry)
+    for i, text, ok in zip(bad, retried, retried_produced):
+        translated[i] = text
+        produced[i] = ok
+    return translated, produced
+
+def apply_translation_memory(journal: CheckpointJournal, texts: List[str]) -> List[str]:
+    """
+    分批之前先查询翻译记忆库，命中的译文直接写入检查点日志，返回未命中、需要发送给API的文本。
+    只对未命中的文本打包，批次仍按 token 预算填满，不会因大部分文本已命中而拆成许多小请求
+    """
+    if translation_memory is None or not texts:
+        return texts
+    cached = translation_memory.lookup(texts)
+    hits = [i for i, c in enumerate(cached) if c is not None and is_valid_translation(texts[i], c)]
+    if hits:
+        journal.append([texts[i] for i in hits], [cached[i] for i in hits])
+        print(f"\033[1;33m翻译记忆库命中 {len(hits)} 条，剩余 {len(texts) - len(hits)} 条需要请求API\033[0m")
+    hit_set = set(hits)
+    return [text for i, text in enumerate(texts) if i not in hit_set]
+
+def pack_batches(texts: List[str]) -> List[List[int]]:
+    """
+    按预估的输入/输出token预算将文本打包为批次，返回每个批次包含的下标。
+    开启 LENGTH_BUCKETING 时先按长度排序，使同一批次内的文本长度接近。
+    """
+    order = list(range(len(texts)))
+    if LENGTH_BUCKETING:
+        order.sort(key=lambda i: estimate_tokens(texts[i]))
     
-    with tqdm(total=len(extracted_texts), 
-             desc=f"线程 {thread_id}", 
-             position=thread_id) as pbar:
+    batches = []
+    current = []
+    input_tokens = 0
+    for i in order:
+        # 按 safe_combine_texts 的编号格式估算，包含编号与换行的开销
+        item_input = estimate_tokens(f"{len(current) + 1}. {texts[i]}\n")
+        if current and (len(current) >= MAX_BATCH_ITEMS
+                        or input_tokens + item_input > MAX_BATCH_INPUT_TOKENS
+                        or (input_tokens + item_input) * OUTPUT_TOKEN_RATIO > MAX_BATCH_OUTPUT_TOKENS):
+            batches.append(current)
+            current = []
+            input_tokens = 0
+            item_input = estimate_tokens(f"1. {texts[i]}\n")
+        current.append(i)
+        input_tokens += item_input
+    if current:
+        batches.append(current)
+    return batches
+
+def build_batch_queue(texts: List[str], batches: List[List[int]]) -> asyncio.Queue:
+    """将所有批次按原顺序放入一个共享队列，任何空闲的 worker 都可以领取"""
+    batch_queue = asyncio.Queue()
+    for indices in batches:
+        batch_queue.put_nowait([texts[i] for i in indices])
+    return batch_queue
+
+async def batch_worker(worker_id: int, batch_queue: asyncio.Queue, journal: CheckpointJournal,
+                       pbar, limiter: AdaptiveLimiter):
+    """从共享队列中不断取出批次翻译，每完成一个批次立即追加到检查点日志，直到队列为空"""
+    current_worker.set(worker_id)
+    while True:
+        try:
+            batch = batch_queue.get_nowait()
+        except asyncio.QueueEmpty:
+            return
         
-        # 第一步：扫描所有可能的缓存
-        for save_idx in range(1, (total_batches + SAVE_EVERY - 1) // SAVE_EVERY + 1):
-            if thread_id == 0 and DEBUG:
-                print(f"\033[1;33m[线程 {thread_id}] 正在检查缓存结果 {save_idx}...\033[0m")
-            existing_result = load_existing_result(thread_id, save_idx)
-            if existing_result is not None:
-                # 计算这个save_count包含的批次数
-                start_batch = (save_idx - 1) * SAVE_EVERY
-                end_batch = min(start_batch + SAVE_EVERY, total_batches)
-                
-                # 标记这些批次为已处理
-                for batch_idx in range(start_batch, end_batch):
-                    batch_status[batch_idx] = True
-                
-                # 计算跳过的数据量
-                start_index = start_batch * BATCH_SIZE
-                end_index = min(end_batch * BATCH_SIZE, len(extracted_texts))
-                skip_count = end_index - start_index
-                
-                # 更新进度条
-                pbar.update(skip_count)
+        key = batch_hash(batch)
+        batch_id = key[:8]
+        if worker_id == 0 and DEBUG:
+            pbar.write(f"\033[1;33m[worker {worker_id}] 正在处理批次 {batch_id} 的 {len(batch)} 条...\033[0m")
         
-        # 第二步：处理实际批次
-        for batch_idx in range(total_batches):
-            # 如果批次已处理（通过缓存），则跳过
-            if batch_status[batch_idx]:
-                continue
+        # 有效的译文在每次响应结束时已写入记忆库
+        translated_batch, produced = await request_translation(batch_id, batch, pbar, limiter)
+        if all(produced):
+            await journal.append_async(batch, translated_batch, key)
+        else:
+            # 失败的批次只记录模型返回了有效译文的行，保留原文的行不记录，下次运行时重试
+            valid = [i for i, ok in enumerate(produced) if ok]
+            if valid:
+                await journal.append_async([batch[i] for i in valid], [translated_batch[i] for i in valid])
+        pbar.update(len(batch))
+        pbar.set_postfix(并发=limiter.limit, 在途=limiter.in_flight)
 
-            if thread_id == 0 and DEBUG:
-                print(f"\033[1;33m[线程 {thread_id}] 正在处理第 {batch_idx + 1} 批次...\033[0m")
-                
-            # 计算当前批次在数据中的位置
-            start_index = batch_idx * BATCH_SIZE
-            end_index = min(start_index + BATCH_SIZE, len(extracted_texts))
-            
-            batch = extracted_texts[start_index:end_index]
-            original_batch = texts[start_index:end_index]
-            
-            # 计算当前save_count
-            save_count = batch_idx // SAVE_EVERY + 1
-            
-            # 处理当前批次
-            combined = safe_combine_texts(batch)
-            
-            success = False
-            translated_batch = []
-            for attempt in range(MAX_RETRIES):
-                try:
-                    completion = client.chat.completions.create(
-                        model="deepseek-chat",
-                        messages=[
-                            {"role": "system", "content": 
-                            #  "你是一个专业的日文翻译助手。只翻译日文部分，严格保持符号、格式和分隔符|||不变，不要修改或解释分隔符；不要添加额外内容，如果遇到无法翻译的内容，原样返回"
-                            "你是一个专业的日文翻译助手。请逐条翻译日文为中文，保留行号和顺序。"
-                        "原文为编号形式（如 1. xxx），你只需将每行的文本部分翻译为中文，编号保持不变。"
-                        "如果某行无法翻译，请原样保留。"
-                            },
-                            {"role": "user", "content": f"翻译以下日文为中文：\n{combined}"}
-                        ],
-                    )
-                    
-                    result = completion.choices[0].message.content
-                    translated_batch = safe_split_result(result, len(batch))
-                    
-                    # 验证并修复翻译结果
-                    translated_batch = validate_and_fix_batch(translated_batch, batch)
-                    
-                    success = True
-                    break
-                    
-                except Exception as e:
-                    pbar.write(f"[线程 {thread_id}] 出错: {str(e)}")
-                    time.sleep(3)
-            
-            if not success:
-                translated_batch = batch  # 失败时保留原文
-            
-            # 重建完整格式
-            partial_structures = structures[start_index:start_index+len(translated_batch)]
-            final_translated = reconstruct_translated_texts(translated_batch, partial_structures)
-            
-            # 添加到累积列表
-            accumulated_translated.extend(final_translated)
-            accumulated_original.extend(original_batch)
-            
-            # 更新进度
-            pbar.update(len(batch))
-            batch_count += 1
-            
-            # 检查是否需要保存
-            if (batch_idx + 1) % SAVE_EVERY == 0 or (batch_idx + 1) == total_batches:
-                # 保存累积的结果和原文
-                save_partial_result(thread_id, save_count, accumulated_translated, accumulated_original)
-                
-                # 重置累积列表
-                accumulated_translated = []
-                accumulated_original = []
-
-def merge_results_from_files() -> List[str]:
-    """从临时文件合并最终结果（仅使用翻译文件）"""
-    # 获取所有翻译临时文件
-    file_pattern = str(OUTPUT_DIR / "*_translated.json")
-    files = glob.glob(file_pattern)
-    
-    # 按线程ID和保存序号排序
-    def sort_key(filename):
-        base = Path(filename).stem
-        parts = base.split('_')
-        thread_id = int(parts[0])
-        save_count = int(parts[1])
-        return (thread_id, save_count)
-    
-    files.sort(key=sort_key)
-    
-    # 合并所有文件
-    final_result = []
-    for file in files:
+async def translate_all(texts: List[str], batches: List[List[int]], journal: CheckpointJournal, done_count: int):
+    """
+    MAX_CONCURRENCY 个 worker 共享同一个批次队列，避免个别慢批次拖长整体耗时；
+    实际在途请求数由 AdaptiveLimiter 根据延迟与 429/5xx 动态调整。
+    """
+    limiter = AdaptiveLimiter(CONCURRENCY, MIN_CONCURRENCY, MAX_CONCURRENCY, TARGET_LATENCY, METRICS_FILE)
+    with tqdm(total=done_count + len(texts), initial=done_count, desc="翻译进度") as pbar:
+        batch_queue = build_batch_queue(texts, batches)
+        await asyncio.gather(*(batch_worker(i, batch_queue, journal, pbar, limiter)
+                               for i in range(MAX_CONCURRENCY)))
+    limiter.export_metrics()
+    print(f"\033[1;33m{limiter.summary()}\033[0m")
+
+def import_legacy_snapshots(journal: CheckpointJournal) -> int:
+    """
+    将旧版 {分片}_{序号}_translated.json / _original.json 快照按内容导入检查点日志，
+    之后无论如何分批都能复用；重复导入不会产生重复记录。返回导入的条数。
+    开启 MASK_CONTROL_CODES 时检查点日志按占位后的原文索引，导入时同样占位，
+    译文中的控制符与原文不一致的条目不导入。
+    """
+    completed = journal.completed_hashes()
+    imported = 0
+    for translated_file in sorted(glob.glob(str(OUTPUT_DIR / "*_translated.json"))):
+        original_file = translated_file[:-len("_translated.json")] + "_original.json"
+        if not os.path.exists(original_file):
+            continue
         try:
-            with open(file, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                final_result.extend(data)
+            with open(translated_file, 'r', encoding='utf-8') as f:
+                translated_data = json.load(f)
+            with open(original_file, 'r', encoding='utf-8') as f:
+                original_data = json.load(f)
         except Exception as e:
-            print(f"\033[1;31m加载文件失败 {file}: {e}\033[0m")
+            print(f"\033[1;31m加载旧版快照失败 {translated_file}: {e}\033[0m")
+            continue
+        
+        # 快照中保存的是带前后缀的完整字符串，去掉与原文相同的前后缀后按提取后的文本记录
+        extracted, structures = extract_text_parts(original_data)
+        sources = []
+        translations = []
+        for source, structure, translated in zip(extracted, structures, translated_data):
+            if structure:
+                prefix, suffix = structure
+                if translated.startswith(prefix) and translated.endswith(suffix):
+                    translated = translated[len(prefix):len(translated) - len(suffix)]
+            # 旧版漏行时会补空字符串或原文，无法与恰好相同的译文区分，与原文相同的条目一律不导入，下次运行时重新翻译
+            if not translated.strip() or translated == source:
+                continue
+            if MASK_CONTROL_CODES:
+                source, codes = mask_text(source)
+                translated, translated_codes = mask_text(translated)
+                if translated_codes != codes:
+                    continue
+            sources.append(source)
+            translations.append(translated)
+        
+        key = batch_hash(sources)
+        if sources and key not in completed:
+            journal.append(sources, translations, key)
+            completed.add(key)
+            imported += len(sources)
+    return imported
+
+async def prepare_glossary(journal: CheckpointJournal) -> Optional[Glossary]:
+    """
+    读取 glossary.json，并从数据库文件中收集新的术语：新术语先作为一轮普通批次翻译
+    （结果同样写入检查点日志与翻译记忆库），再合并保存到 glossary.json
+    """
+    data_dir = next((d for d in GLOSSARY_DATA_DIRS if d.exists()), None)
+    entries = load_glossary(GLOSSARY_FILE)
+    terms = collect_terms(data_dir) if data_dir is not None else []
+    missing = [term for term in terms if term not in entries]
+    if missing:
+        index = journal.build_index()
+        pending = apply_translation_memory(journal, [term for term in missing if term not in index])
+        if pending:
+            print(f"\n\033[1;36m翻译术语表: {len(pending)} 条新术语...\033[0m")
+            await translate_all(pending, pack_batches(pending), journal, 0)
+        index = journal.build_index()
+        for term in missing:
+            translated = index.get(term)
+            if translated and not KANA_REGEX.search(translated):
+                entries[term] = translated
+        save_glossary(entries, GLOSSARY_FILE)
+    if not entries:
+        return None
+    print(f"\033[1;33m术语表: {len(entries)} 条 ({GLOSSARY_FILE})\033[0m")
+    return Glossary(entries)
+
+async def translate_pending(journal: CheckpointJournal, work_extracted: List[str], total_count: int):
+    """
+    依次翻译新术语与正文中尚未翻译的文本。两者必须在同一个事件循环中运行：
+    AsyncOpenAI 的连接池绑定在创建连接的事件循环上，分两次 asyncio.run 时第二次会因事件循环已关闭而连接失败
+    """
+    global glossary, prompt_builder
+    if USE_GLOSSARY:
+        glossary = await prepare_glossary(journal)
+        prompt_builder = PromptBuilder(SYSTEM_PROMPT, glossary)
+    
+    # 按内容跳过已翻译的文本，剩余文本重新分批（与之前的分批方式、输入顺序无关）
+    index = journal.build_index()
+    # 只有控制符参数不同的文本占位后相同，只需翻译一次
+    distinct_texts = list(dict.fromkeys(work_extracted))
+    pending_texts = [text for text in distinct_texts if text not in index]
+    if len(pending_texts) < len(distinct_texts):
+        print(f"\033[1;33m检查点中已有 {len(distinct_texts) - len(pending_texts)} 条译文，"
+              f"剩余 {len(pending_texts)} 条待翻译\033[0m")
+    pending_texts = apply_translation_memory(journal, pending_texts)
+    done_count = len(distinct_texts) - len(pending_texts)
+    batches = pack_batches(pending_texts)
     
-    return final_result
+    print(f"\n\033[1;36m开始翻译 {total_count} 条字符串，共 {len(batches)} 个批次, 初始 {CONCURRENCY} 个并发请求 (自适应 {MIN_CONCURRENCY}~{MAX_CONCURRENCY})...\033[0m")
+    print(f"\033[1;33m配置: 每批预估输入 ≤{MAX_BATCH_INPUT_TOKENS} / 输出 ≤{MAX_BATCH_OUTPUT_TOKENS} tokens "
+          f"(最多 {MAX_BATCH_ITEMS} 条), 每完成一批追加写入 {JOURNAL_FILE}\033[0m")
+    await translate_all(pending_texts, batches, journal, done_count)
+
+def merge_results_from_files(journal: CheckpointJournal, texts: List[str]) -> Tuple[List[str], List[bool]]:
+    """
+    单次顺序读取检查点日志建立 原文 → 译文 索引并合并最终结果，未完成的条目保留原文；
+    同时返回每条是否已翻译（检查点日志中只记录模型返回的有效译文）
+    """
+    index = journal.build_index()
+    return [index.get(text, text) for text in texts], [text in index for text in texts]
 
 def main():
     # 验证输入文件
@@ -312,48 +626,102 @@ def main():
     
     # 读取并拆分数据
     try:
-        parts = split_json(INPUT_FILE, THREAD_COUNT)
-        total_items = sum(len(part) for part in parts)
+        source_texts = load_source_texts(INPUT_FILE)
     except Exception as e:
         print(f"读取输入文件失败: {e}")
         return
+
+    # 增量模式：只翻译新增或修改的字符串，其余直接复用上一次的译文
+    reuse = load_reuse(REUSE_FILE, len(source_texts))
+    if reuse is not None:
+        delta_positions = [i for i, reused in enumerate(reuse) if reused is None]
+        print(f"\n\033[1;36m增量模式: 复用 {len(source_texts) - len(delta_positions)} 条译文, "
+              f"需要翻译 {len(delta_positions)} 条\033[0m")
+
+    source_files = load_source_files(len(source_texts))
+    if reuse is not None:
+        source_texts = [source_texts[i] for i in delta_positions]
+        if source_files is not None:
+            source_files = [source_files[i] for i in delta_positions]
+
+    work_texts = source_texts
+    if DEDUP:
+        unique_texts, positions, structures = dedup_texts(source_texts)
+        work_texts = unique_texts
+        dedup_ratio = 1 - len(unique_texts) / len(source_texts) if source_texts else 0.0
+        print(f"\n\033[1;36m去重: {len(source_texts)} 条 → {len(unique_texts)} 条唯一文本, "
+              f"去重率 {dedup_ratio:.1%}\033[0m")
+
+    work_extracted, work_structures = extract_text_parts(work_texts)
+    work_unmasked, work_codes = work_extracted, None
+    if MASK_CONTROL_CODES:
+        work_extracted, work_codes = mask_texts(work_unmasked)
+        masked_count = sum(1 for c in work_codes if c)
+        saved_chars = sum(len(a) - len(b) for a, b in zip(work_unmasked, work_extracted))
+        print(f"\033[1;36m控制符占位: {masked_count} 条文本含控制符, 减少 {saved_chars} 个字符\033[0m")
     
-    # 准备多线程
-    threads = []
-    
-    print(f"\n\033[1;36m开始翻译 {total_items} 条字符串，使用 {THREAD_COUNT} 个线程...\033[0m")
-    print(f"\033[1;33m配置: 每批 {BATCH_SIZE} 条, 每 {SAVE_EVERY} 批保存一次\033[0m")
-    print("\033[1;33m每个线程进度:\033[0m")
-    start_time = time.time()
+    journal = CheckpointJournal(JOURNAL_FILE)
+    imported = import_legacy_snapshots(journal)
+    if imported:
+        print(f"\033[1;33m已从旧版快照文件导入 {imported} 条译文到 {JOURNAL_FILE}\033[0m")
     
-    # 启动线程
-    for i in range(THREAD_COUNT):
-        t = threading.Thread(
-            target=batch_translate,
-            args=(i, parts[i]),
-            daemon=True
-        )
-        t.start()
-        threads.append(t)
-        time.sleep(0.1)  # 避免进度条错位
+    global translation_memory, usage_ledger
+    if RECORD_USAGE:
+        usage_ledger = UsageLedger(LEDGER_FILE, MODEL_NAME)
+        if source_files is not None:
+            # 发送给API的是去重、占位后的文本，按其对应的原始位置登记所属文件
+            units = positions if DEDUP else range(len(source_texts))
+            for file_name, unit in zip(source_files, units):
+                usage_ledger.attribute(work_extracted[unit], file_name)
+    if USE_TM:
+        # 术语表会影响译文，开启时使用单独的记忆库版本
+        prompt_version = PROMPT_VERSION + ("+glossary" if USE_GLOSSARY else "")
+        translation_memory = TranslationMemory(TM_FILE, MODEL_NAME, prompt_version)
     
-    # 等待所有线程完成
-    for t in threads:
-        t.join()
+    start_time = time.time()
+    try:
+        asyncio.run(translate_pending(journal, work_extracted, len(work_texts)))
+    finally:
+        journal.close()
     
-    # 从文件合并结果
-    print("\n\033[1;36m合并临时文件...\033[0m")
-    final_result = merge_results_from_files()
+    # 从检查点日志合并结果
+    print("\n\033[1;36m合并检查点日志...\033[0m")
+    merged, work_status = merge_results_from_files(journal, work_extracted)
+    if work_codes is not None:
+        # 占位符不完整的条目在重建时改用原文
+        work_status = [ok and placeholders_match(source, text)
+                       for ok, source, text in zip(work_status, work_extracted, merged)]
+    final_result = reconstruct_translated_texts(merged, work_structures, work_extracted, work_codes, work_unmasked)
+    final_status = work_status
+    if DEDUP:
+        final_result = expand_dedup_results(final_result, unique_texts, positions, structures)
+        final_status = [work_status[idx] for idx in positions]
+    if reuse is not None:
+        # 复用的都是上一次由模型翻译的译文
+        status = [True] * len(reuse)
+        for pos, translated, ok in zip(delta_positions, final_result, final_status):
+            reuse[pos] = translated
+            status[pos] = ok
+        final_result, final_status = reuse, status
     
     # 保存最终结果
     try:
-        with open("translation_strings_cn.json", 'w', encoding='utf-8') as f:
-            json.dump(final_result, f, ensure_ascii=False, indent=2)
+        json_backend.dump_file(final_result, Path("translation_strings_cn.json"))
+        # 写回时记入基线，增量模式据此区分翻译失败保留的原文与恰好与原文相同的译文
+        json_backend.dump_file(final_status, STATUS_FILE)
     except Exception as e:
         print(f"\033[1;31m保存最终结果失败: {e}\033[0m")
     
+    print(f"\033[1;33m{cache_stats.summary()}\033[0m")
+    if translation_memory is not None:
+        print(f"\033[1;33m{translation_memory.summary()}\033[0m")
+        translation_memory.close()
+    if usage_ledger is not None:
+        usage_ledger.close()
+        print(f"\033[1;33m用量账本: {LEDGER_FILE}（运行 python usage_ledger.py 查看按文件/worker/小时的费用）\033[0m")
+    
     print(f"\n\033[1;32m翻译完成! 总耗时: {time.time()-start_time:.2f}秒\033[0m")
-    print(f"\033[1;33m临时文件保存在: {OUTPUT_DIR}\033[0m")
+    print(f"\033[1;33m检查点日志保存在: {JOURNAL_FILE}\033[0m")
     print(f"\033[1;33m最终结果保存在: translation_strings_cn.json\033[0m")
 
 if __name__ == "__main__":
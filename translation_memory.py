@@ -0,0 +1,130 @@
+import asyncio
+import sqlite3
+import threading
+import time
+import unicodedata
+from pathlib import Path
+from typing import List, Optional
+
+# ========== 配置 ==========
+TM_FILE = Path("translation_memory.sqlite3")  # 与 json_temp 同级，可在多次运行、多个游戏间共享
+TM_MAX_ENTRIES = 500000  # 最多保留的条目数，超出后按最近最少使用淘汰
+EVICT_CHECK_EVERY = 1000  # 每写入多少条检查一次容量
+
+
+def normalize_source(text: str) -> str:
+    """规范化日文原文作为记忆库的键（全半角统一、去除首尾空白）"""
+    return unicodedata.normalize("NFKC", str(text)).strip()
+
+
+class TranslationMemory:
+    """基于SQLite的翻译记忆库，键为 (规范化原文, 模型, 提示词版本)"""
+
+    def __init__(self, db_file: Path = TM_FILE, model: str = "", prompt_version: str = "",
+                 max_entries: int = TM_MAX_ENTRIES):
+        self.db_file = Path(db_file)
+        self.model = model
+        self.prompt_version = prompt_version
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.stored = 0
+        self.evicted = 0
+        self._pending_writes = 0
+        self._lock = threading.Lock()
+
+        self._conn = sqlite3.connect(str(self.db_file), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS tm ("
+            " source TEXT NOT NULL,"
+            " model TEXT NOT NULL,"
+            " prompt_version TEXT NOT NULL,"
+            " translation TEXT NOT NULL,"
+            " last_used REAL NOT NULL,"
+            " PRIMARY KEY (source, model, prompt_version))"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_tm_last_used ON tm(last_used)")
+        self._conn.commit()
+
+    def lookup(self, texts: List[str]) -> List[Optional[str]]:
+        """批量查询，返回与输入等长的列表，未命中的位置为 None"""
+        keys = [normalize_source(t) for t in texts]
+        found = {}
+        with self._lock:
+            unique_keys = list(dict.fromkeys(keys))
+            # SQLite 单条语句的参数数量有限，分块查询
+            for i in range(0, len(unique_keys), 500):
+                chunk = unique_keys[i:i + 500]
+                placeholders = ",".join("?" * len(chunk))
+                rows = self._conn.execute(
+                    f"SELECT source, translation FROM tm WHERE model = ? AND prompt_version = ? "
+                    f"AND source IN ({placeholders})",
+                    [self.model, self.prompt_version, *chunk],
+                ).fetchall()
+                found.update(rows)
+
+            if found:
+                now = time.time()
+                self._conn.executemany(
+                    "UPDATE tm SET last_used = ? WHERE source = ? AND model = ? AND prompt_version = ?",
+                    [(now, key, self.model, self.prompt_version) for key in found],
+                )
+                self._conn.commit()
+
+            results = [found.get(key) for key in keys]
+            hit_count = sum(1 for r in results if r is not None)
+            self.hits += hit_count
+            self.misses += len(results) - hit_count
+        return results
+
+    def store(self, texts: List[str], translations: List[str]):
+        """写入成功的翻译结果"""
+        now = time.time()
+        rows = [
+            (normalize_source(src), self.model, self.prompt_version, dst, now)
+            for src, dst in zip(texts, translations)
+        ]
+        if not rows:
+            return
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO tm (source, model, prompt_version, translation, last_used) "
+                "VALUES (?, ?, ?, ?, ?)",
+                rows,
+            )
+            self._conn.commit()
+            self.stored += len(rows)
+            self._pending_writes += len(rows)
+            if self._pending_writes >= EVICT_CHECK_EVERY:
+                self._evict()
+
+    async def store_async(self, texts: List[str], translations: List[str]):
+        """在线程池中执行 store：SQLite 提交与 WAL 检查点会 fsync，直接在事件循环中执行会阻塞所有在途的流式请求"""
+        await asyncio.to_thread(self.store, texts, translations)
+
+    def _evict(self):
+        """按 last_used 淘汰超出容量的旧条目（调用方需持有锁）"""
+        self._pending_writes = 0
+        total = self._conn.execute("SELECT COUNT(*) FROM tm").fetchone()[0]
+        overflow = total - self.max_entries
+        if overflow <= 0:
+            return
+        self._conn.execute(
+            "DELETE FROM tm WHERE rowid IN (SELECT rowid FROM tm ORDER BY last_used LIMIT ?)",
+            (overflow,),
+        )
+        self._conn.commit()
+        self.evicted += overflow
+
+    def summary(self) -> str:
+        total = self.hits + self.misses
+        hit_rate = self.hits / total if total else 0.0
+        return (f"翻译记忆库: 命中 {self.hits} 条, 未命中 {self.misses} 条, 命中率 {hit_rate:.1%}, "
+                f"新写入 {self.stored} 条, 淘汰 {self.evicted} 条 ({self.db_file})")
+
+    def close(self):
+        with self._lock:
+            self._evict()
+            self._conn.close()
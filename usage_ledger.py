@@ -0,0 +1,301 @@
+import argparse
+import contextvars
+import re
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import json_backend
+from prompt_cache import cache_tokens
+
+# ========== 配置 ==========
+LEDGER_FILE = Path("json_temp") / "usage_ledger.jsonl"  # 每个完成的API请求追加一行
+CALIBRATION_FILE = Path("token_calibration.json")      # usage_ledger.py --calibrate 拟合的结果，供离线估算使用
+UNATTRIBUTED = "-"  # 无法对应到数据文件的文本（如术语表）
+
+# 按字符类别拟合 token/字符 比例；先验值用于记录不足时，PRIOR_WEIGHT_CHARS 为先验相当的字符数
+SCRIPT_CLASSES = {
+    "kana": re.compile(r"[\u3040-\u30ff\uff66-\uff9f]"),
+    "cjk": re.compile(r"[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]"),
+    "ascii": re.compile(r"[\x00-\x7f]"),
+}
+OTHER_CLASS = "other"
+PRIOR_RATIOS = {"kana": 0.8, "cjk": 0.7, "ascii": 0.3, "other": 0.8}
+PRIOR_WEIGHT_CHARS = 200
+
+# ========== 价格参数 ==========
+# 元/千tokens；standard 为标准价格（与 prompt_cache 一致），offpeak 为 DeepSeek 错峰时段价格
+PRICES = {
+    "standard": {"cache_hit": 0.0005, "cache_miss": 0.002, "output": 0.008},
+    "offpeak": {"cache_hit": 0.00025, "cache_miss": 0.001, "output": 0.004},
+}
+OFFPEAK_START = (0, 30)  # 北京时间 00:30
+OFFPEAK_END = (8, 30)    # 北京时间 08:30
+BEIJING = timezone(timedelta(hours=8))
+
+# 当前请求所属的 worker，由 translate_v4.batch_worker 设置（每个 worker 协程有独立的上下文）
+current_worker: contextvars.ContextVar[Optional[int]] = contextvars.ContextVar("current_worker", default=None)
+
+
+def char_counts(text: str) -> Dict[str, int]:
+    """按字符类别统计字符数"""
+    counts = {name: len(regex.findall(text)) for name, regex in SCRIPT_CLASSES.items()}
+    counts[OTHER_CLASS] = len(text) - sum(counts.values())
+    return {name: count for name, count in counts.items() if count}
+
+
+def is_offpeak(ts: float) -> bool:
+    now = datetime.fromtimestamp(ts, BEIJING)
+    return OFFPEAK_START <= (now.hour, now.minute) < OFFPEAK_END
+
+
+def request_cost(record: dict, tier: Optional[str] = None) -> float:
+    """按请求时间所在时段（或指定的 tier）计算一条记录的费用；未返回缓存字段时按全部未命中计"""
+    prices = PRICES[tier or ("offpeak" if is_offpeak(record["ts"]) else "standard")]
+    prompt = record.get("prompt_tokens") or 0
+    hit = record.get("cache_hit") or 0
+    miss = record.get("cache_miss")
+    if miss is None:
+        miss = prompt - hit
+    return (hit * prices["cache_hit"] + miss * prices["cache_miss"]
+            + (record.get("completion_tokens") or 0) * prices["output"]) / 1000
+
+
+class UsageLedger:
+    """
+    追加写入的用量账本：每个完成的请求写一行，记录服务端返回的真实 token 用量、延迟、
+    重试次数与批次中文本所属的文件，供 usage_ledger.py 统计费用并校准离线估算
+    """
+
+    def __init__(self, ledger_file: Path = LEDGER_FILE, model: str = ""):
+        self.ledger_file = Path(ledger_file)
+        self.ledger_file.parent.mkdir(exist_ok=True)
+        self.model = model
+        self._files: Dict[str, Dict[str, int]] = defaultdict(lambda: defaultdict(int))
+        self._file = None
+
+    def attribute(self, text: str, file_name: str):
+        """登记发送给API的文本出现在哪个文件中（去重后的文本可能出现在多个文件中）"""
+        self._files[text][file_name] += 1
+
+    def file_shares(self, batch: List[str]) -> Dict[str, float]:
+        """按字符数将批次分摊到各文件，同一文本出现在多个文件时按出现次数分摊"""
+        shares = defaultdict(float)
+        for text in batch:
+            files = self._files.get(text) or {UNATTRIBUTED: 1}
+            occurrences = sum(files.values())
+            for file_name, count in files.items():
+                shares[file_name] += len(text) * count / occurrences
+        return {file_name: round(chars, 1) for file_name, chars in shares.items()}
+
+    def record(self, batch_id: str, batch: List[str], messages: List[dict], output: str, usage,
+               latency: float, retries: int, line_retry: int, finish_reason: Optional[str]):
+        hit, miss = cache_tokens(usage)
+        prompt_chars = defaultdict(int)
+        for message in messages:
+            for name, count in char_counts(message["content"]).items():
+                prompt_chars[name] += count
+        entry = {
+            "ts": round(time.time(), 3),
+            "model": self.model,
+            "batch": batch_id,
+            "worker": current_worker.get(),
+            "items": len(batch),
+            "retries": retries,
+            "line_retry": line_retry,
+            "finish": finish_reason,
+            "latency": round(latency, 3),
+            "prompt_tokens": getattr(usage, "prompt_tokens", None),
+            "completion_tokens": getattr(usage, "completion_tokens", None),
+            "cache_hit": hit,
+            "cache_miss": miss,
+            "prompt_chars": dict(prompt_chars),
+            "batch_chars": char_counts(messages[-1]["content"]),
+            "output_chars": char_counts(output),
+            "files": self.file_shares(batch),
+        }
+        if self._file is None:
+            self._file = open(self.ledger_file, "ab")
+        self._file.write(json_backend.dumps(entry, "compact") + b"\n")
+        self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def load_ledger(ledger_files: List[Path]) -> Iterator[dict]:
+    """逐行读取账本记录，跳过写了一半的行"""
+    for ledger_file in ledger_files:
+        if not ledger_file.exists():
+            continue
+        with open(ledger_file, "rb") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    yield json_backend.loads(line)
+                except ValueError:
+                    continue
+
+
+# ========== 校准 ==========
+def solve_linear(matrix: List[List[float]], vector: List[float]) -> List[float]:
+    """高斯消元（部分主元）求解小型线性方程组"""
+    n = len(vector)
+    a = [row[:] + [vector[i]] for i, row in enumerate(matrix)]
+    for col in range(n):
+        pivot = max(range(col, n), key=lambda r: abs(a[r][col]))
+        a[col], a[pivot] = a[pivot], a[col]
+        for r in range(col + 1, n):
+            factor = a[r][col] / a[col][col]
+            for c in range(col, n + 1):
+                a[r][c] -= factor * a[col][c]
+    x = [0.0] * n
+    for r in range(n - 1, -1, -1):
+        x[r] = (a[r][n] - sum(a[r][c] * x[c] for c in range(r + 1, n))) / a[r][r]
+    return x
+
+
+def fit_ratios(samples: List[Tuple[Dict[str, int], int]]) -> Dict[str, float]:
+    """
+    以 tokens ≈ Σ 比例[类别] × 字符数[类别] 拟合各字符类别的 token/字符 比例（最小二乘）。
+    每个类别额外加入一个按 PRIOR_RATIOS 构造的虚拟样本，记录很少或某类字符很少出现时结果接近先验值。
+    """
+    names = list(PRIOR_RATIOS)
+    rows = [([chars.get(name, 0) for name in names], tokens) for chars, tokens in samples]
+    for i, name in enumerate(names):
+        row = [0] * len(names)
+        row[i] = PRIOR_WEIGHT_CHARS
+        rows.append((row, PRIOR_RATIOS[name] * PRIOR_WEIGHT_CHARS))
+    matrix = [[sum(x[i] * x[j] for x, _ in rows) for j in range(len(names))] for i in range(len(names))]
+    vector = [sum(x[i] * y for x, y in rows) for i in range(len(names))]
+    return {name: round(max(ratio, 0.0), 4) for name, ratio in zip(names, solve_linear(matrix, vector))}
+
+
+def fit_latency(records: List[dict]) -> Dict[str, float]:
+    """以 延迟 ≈ 基础延迟 + 每输出token秒数 × 输出token 拟合（只使用未提前中止的请求）"""
+    points = [(r["completion_tokens"], r["latency"]) for r in records
+              if r.get("completion_tokens") and r.get("finish") in ("stop", "length")]
+    if len(points) < 2:
+        return {}
+    n = len(points)
+    mean_x = sum(x for x, _ in points) / n
+    mean_y = sum(y for _, y in points) / n
+    var_x = sum((x - mean_x) ** 2 for x, _ in points)
+    slope = sum((x - mean_x) * (y - mean_y) for x, y in points) / var_x if var_x else 0.0
+    return {"base_seconds": round(max(mean_y - slope * mean_x, 0.0), 3),
+            "seconds_per_output_token": round(max(slope, 0.0), 5)}
+
+
+def calibrate(records: List[dict]) -> dict:
+    """从账本拟合离线估算使用的参数"""
+    measured = [r for r in records if r.get("prompt_tokens") is not None and r.get("completion_tokens") is not None]
+    finished = [r for r in measured if r.get("finish") == "stop"]
+    batch_chars = sum(sum(r["batch_chars"].values()) for r in measured)
+    output_chars = sum(sum(r["output_chars"].values()) for r in finished)
+    stop_batch_chars = sum(sum(r["batch_chars"].values()) for r in finished)
+    return {
+        "requests": len(measured),
+        "input_ratios": fit_ratios([(r["prompt_chars"], r["prompt_tokens"]) for r in measured]),
+        "output_ratios": fit_ratios([(r["output_chars"], r["completion_tokens"]) for r in measured]),
+        # 输出token ≈ Σ 比例 × 待翻译部分各类别字符数：离线估算时只知道原文，用它直接由原文估算输出
+        "output_ratios_by_source": fit_ratios([(r["batch_chars"], r["completion_tokens"]) for r in finished]),
+        # 译文字符数 / 待翻译部分（编号列表）字符数，只统计正常结束的请求
+        "output_chars_per_input_char": round(output_chars / stop_batch_chars, 4) if stop_batch_chars else None,
+        "cache_hit_rate": round(sum(r.get("cache_hit") or 0 for r in measured)
+                                / max(sum(r["prompt_tokens"] for r in measured), 1), 4),
+        "latency": fit_latency(measured),
+        "batch_chars": batch_chars,
+    }
+
+
+def load_calibration(calibration_file: Path = CALIBRATION_FILE) -> Optional[dict]:
+    if not calibration_file.exists():
+        return None
+    return json_backend.load_file(calibration_file)
+
+
+# ========== 报表 ==========
+def print_table(title: str, costs: Dict, tokens: Dict, limit: int):
+    print(f"\n\033[1;36m{title}\033[0m")
+    print(f"{'':<28}{'费用(¥)':>12}{'输入tokens':>14}{'输出tokens':>14}")
+    rows = sorted(costs.items(), key=lambda item: -item[1])
+    for key, cost in rows[:limit] if limit else rows:
+        prompt, completion = tokens[key]
+        print(f"{str(key):<28}{cost:>12.4f}{prompt:>14.0f}{completion:>14.0f}")
+    if limit and len(rows) > limit:
+        print(f"... 其余 {len(rows) - limit} 项")
+
+
+def report(records: List[dict], limit: int):
+    measured = [r for r in records if r.get("prompt_tokens") is not None]
+    if not measured:
+        print("账本中没有返回用量的请求")
+        return
+    by_file, by_worker, by_hour = defaultdict(float), defaultdict(float), defaultdict(float)
+    file_tokens, worker_tokens, hour_tokens = (defaultdict(lambda: [0.0, 0.0]) for _ in range(3))
+    for r in measured:
+        cost = request_cost(r)
+        prompt, completion = r["prompt_tokens"], r.get("completion_tokens") or 0
+        hour = datetime.fromtimestamp(r["ts"]).strftime("%Y-%m-%d %H:00")
+        worker = r.get("worker") if r.get("worker") is not None else UNATTRIBUTED
+        for key, costs, tokens in ((worker, by_worker, worker_tokens), (hour, by_hour, hour_tokens)):
+            costs[key] += cost
+            tokens[key][0] += prompt
+            tokens[key][1] += completion
+        total_chars = sum(r["files"].values()) or 1
+        for file_name, chars in r["files"].items():
+            share = chars / total_chars
+            by_file[file_name] += cost * share
+            file_tokens[file_name][0] += prompt * share
+            file_tokens[file_name][1] += completion * share
+
+    prompt_total = sum(r["prompt_tokens"] for r in measured)
+    completion_total = sum(r.get("completion_tokens") or 0 for r in measured)
+    hit_total = sum(r.get("cache_hit") or 0 for r in measured)
+    prompt_chars = sum(sum(r["prompt_chars"].values()) for r in measured)
+    output_chars = sum(sum(r["output_chars"].values()) for r in measured)
+    retries = sum(r.get("retries", 0) for r in measured)
+    offpeak = sum(1 for r in measured if is_offpeak(r["ts"]))
+
+    print("\033[1;36m===== 用量账本 =====\033[0m")
+    print(f"请求数: {len(records)}（其中 {len(records) - len(measured)} 个未返回用量）, 错峰时段 {offpeak} 个, 重试 {retries} 次")
+    print(f"输入: {prompt_total} tokens（缓存命中 {hit_total}, {hit_total / max(prompt_total, 1):.1%}）, 输出: {completion_total} tokens")
+    print(f"实际费用: ¥{sum(by_hour.values()):.4f}"
+          f"（全部按标准价 ¥{sum(request_cost(r, 'standard') for r in measured):.4f}）")
+    print(f"token/字符: 输入 {prompt_total / max(prompt_chars, 1):.3f}（含系统提示词等固定前缀）, "
+          f"输出 {completion_total / max(output_chars, 1):.3f}")
+
+    calibration = calibrate(records)
+    print("按字符类别拟合: 输入 " + ", ".join(f"{k} {v}" for k, v in calibration["input_ratios"].items())
+          + " | 输出 " + ", ".join(f"{k} {v}" for k, v in calibration["output_ratios"].items()))
+
+    print_table("按文件", by_file, file_tokens, limit)
+    print_table("按 worker", by_worker, worker_tokens, limit)
+    print_table("按小时", dict(sorted(by_hour.items())), hour_tokens, 0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="统计 translate_v4.py 记录的API用量与费用，或据此校准离线估算")
+    parser.add_argument("ledgers", nargs="*", type=Path, default=[LEDGER_FILE], help="账本文件（可多个，默认 %(default)s）")
+    parser.add_argument("--top", type=int, default=20, help="按文件/worker 统计时显示的行数（0 为全部）")
+    parser.add_argument("--calibrate", action="store_true", help=f"拟合 token/字符 比例等参数并保存到 {CALIBRATION_FILE}")
+    args = parser.parse_args()
+
+    records = list(load_ledger(args.ledgers))
+    if not records:
+        print(f"没有找到账本记录: {', '.join(map(str, args.ledgers))}")
+        return
+    report(records, args.top)
+    if args.calibrate:
+        json_backend.dump_file(calibrate(records), CALIBRATION_FILE)
+        print(f"\n\033[1;32m校准参数已保存到: {CALIBRATION_FILE}\033[0m")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,58 +1,171 @@
 import os
-import json
+import hashlib
 import shutil
+import tempfile
 import re
+import argparse
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
+from typing import List, Optional, Tuple
 from tqdm import tqdm
+import json_backend
+from json_walk import iter_string_slots
+from string_manifest import (MANIFEST_FILE, BASELINE_FILE, STATUS_FILE, load_manifest, group_translations_by_file,
+                             parse_pointer, source_hash, save_baseline)
 
 # ========== 配置 ==========
 SOURCE_DIR = Path("www/data_bak")
 OUTPUT_DIR = Path("www/data")
-TRANSLATION_FILE = Path("translation_strings_cn.json")  # 翻译后的结果（必须和原提取顺序一致）
+TRANSLATION_FILE = Path("translation_strings_cn.json")  # 翻译后的结果（与 translation_manifest.json 一一对应）
 JP_REGEX = re.compile(r'[\u3040-\u30ff\u4e00-\u9fff]+')
+RESTORED_FILES = ["CommonEvents.json", "Tilesets.json"]  # 不写回译文，直接从源目录恢复的文件
+JOBS = 1  # 并行写回文件的进程数，1 为单进程（可用 --jobs 覆盖）
 
 # ========== 读取翻译结果 ==========
 def load_translations() -> list:
     if not TRANSLATION_FILE.exists():
         raise FileNotFoundError(f"未找到翻译文件: {TRANSLATION_FILE}")
-    with open(TRANSLATION_FILE, "r", encoding="utf-8") as f:
-        return json.load(f)
+    return json_backend.load_file(TRANSLATION_FILE)
+
+def load_status(count: int) -> Optional[list]:
+    """读取 translate_v4.py 记录的每条是否由模型翻译；不存在或条数不一致时返回 None，增量模式改为按内容判断"""
+    if not STATUS_FILE.exists():
+        return None
+    status = json_backend.load_file(STATUS_FILE)
+    return status if len(status) == count else None
 
 # ========== 写回函数 ==========
-def write_back_translations(obj, translations, idx_ptr, key_path=None) -> object:
-    """递归地将翻译结果写回原结构，key_path 是用于追踪键路径的列表"""
-    if key_path is None:
-        key_path = []
-
-    if isinstance(obj, dict):
-        return {k: write_back_translations(v, translations, idx_ptr, key_path + [k]) for k, v in obj.items()}
-    elif isinstance(obj, list):
-        return [write_back_translations(item, translations, idx_ptr, key_path) for item in obj]
-    elif isinstance(obj, str):
-        if JP_REGEX.search(obj):  # 是待翻译的字符串
-            # 如果当前键路径中包含 "image"，则跳过该字符串
-            if "image" in key_path:
-                idx_ptr[0] += 1
-                print(f"跳过替换 image 字段: {obj}")
-                return obj
-            
-            if idx_ptr[0] >= len(translations):
-                raise IndexError("翻译结果数量不足，无法匹配所有原始字符串。")
-            
-            translated = translations[idx_ptr[0]]
+def write_back_translations(obj, translations, idx_ptr) -> object:
+    """按遍历顺序将翻译结果原地写回原结构，idx_ptr 记录已使用的翻译条数"""
+    for parent, key, key_path, text in iter_string_slots(obj, JP_REGEX.search):  # 是待翻译的字符串
+        # 如果当前键路径中包含 "image"，则跳过该字符串
+        if "image" in key_path:
             idx_ptr[0] += 1
-            return translated
+            print(f"跳过替换 image 字段: {text}")
+            continue
+
+        if idx_ptr[0] >= len(translations):
+            raise IndexError("翻译结果数量不足，无法匹配所有原始字符串。")
+
+        parent[key] = translations[idx_ptr[0]]
+        idx_ptr[0] += 1
+    return obj
+
+def resolve_pointer(obj, tokens: list):
+    """返回 JSON Pointer 指向位置的 (所在容器, 键或下标)，路径不存在时抛出异常"""
+    parent = obj
+    for token in tokens[:-1]:
+        parent = parent[int(token)] if isinstance(parent, list) else parent[token]
+    key = int(tokens[-1]) if isinstance(parent, list) else tokens[-1]
+    parent[key]
+    return parent, key
+
+def redistribute_lines(translated: str, slots: int) -> List[str]:
+    """
+    将合并翻译的多行对话按原行数重新分配：行数一致时逐行对应，
+    行数不足时后面的行留空，行数过多时按字数尽量均匀地合并相邻行
+    """
+    lines = translated.split("\n")
+    if len(lines) <= slots:
+        return lines + [""] * (slots - len(lines))
+
+    result = []
+    remaining = sum(len(line) for line in lines)
+    i = 0
+    for slot in range(slots):
+        slots_left = slots - slot
+        if slots_left == 1:
+            result.append("".join(lines[i:]))
+            break
+        target = remaining / slots_left
+        current = lines[i]
+        i += 1
+        # 至少为后面的每一行各留一行原文
+        while len(lines) - i > slots_left - 1 and len(current) + len(lines[i]) / 2 <= target:
+            current += lines[i]
+            i += 1
+        result.append(current)
+        remaining -= len(current)
+    return result
+
+def write_back_by_pointer(obj, patches: dict, stats: dict) -> object:
+    """
+    按清单中的 JSON Pointer 原地写回译文，patches 为 {pointer: (原文哈希, 译文, 各行 pointer 或 None)}。
+    只沿每个 pointer 访问目标位置，不复制整棵树、也不对每个字符串做正则匹配；
+    原文哈希不一致（数据已变化）或路径不存在的位置保留原文。
+    合并翻译的多行对话按原来的行数重新分配到各行。
+    """
+    for pointer, (expected_hash, translated, line_pointers) in patches.items():
+        token_lists = [parse_pointer(p) for p in (line_pointers or [pointer])]
+        # 如果路径中包含 "image"，则跳过该字符串
+        if any("image" in tokens for tokens in token_lists):
+            stats["skipped"] += 1
+            continue
+
+        try:
+            slots = [resolve_pointer(obj, tokens) for tokens in token_lists]
+        except (KeyError, IndexError, ValueError, TypeError):
+            print(f"跳过不存在的位置: {pointer}")
+            stats["mismatched"] += 1
+            continue
+
+        originals = [parent[key] for parent, key in slots]
+        if not all(isinstance(original, str) for original in originals) \
+                or source_hash("\n".join(originals)) != expected_hash:
+            print(f"跳过原文已变化的位置: {pointer}")
+            stats["mismatched"] += 1
+            continue
+
+        lines = redistribute_lines(translated, len(slots)) if line_pointers else [translated]
+        for (parent, key), line in zip(slots, lines):
+            parent[key] = line
+        stats["applied"] += 1
+    return obj
+
+# ========== 差异写入 ==========
+def file_digest(path: Path) -> Optional[str]:
+    """文件内容哈希，文件不存在时返回 None"""
+    if not path.exists():
+        return None
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def default_file_mode() -> int:
+    """新建文件时的权限（与 open() 创建文件时一致：0o666 去掉 umask）"""
+    umask = os.umask(0)
+    os.umask(umask)
+    return 0o666 & ~umask
+
+def write_if_changed(path: Path, data: bytes, stat_source: Optional[Path] = None) -> bool:
+    """
+    内容哈希与现有文件一致时不写入；否则先写同目录临时文件再原子替换，
+    中途中断不会留下半截的游戏数据。mkstemp 创建的临时文件权限为 0600，替换前改为原文件的权限
+    （新文件按 umask），给定 stat_source 时复制其权限与修改时间。返回是否实际写入。
+    """
+    if file_digest(path) == hashlib.sha1(data).hexdigest():
+        return False
+    fd, tmp_name = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        if stat_source is not None:
+            shutil.copystat(stat_source, tmp_name)
         else:
-            return obj
-    else:
-        return obj
+            os.chmod(tmp_name, path.stat().st_mode & 0o7777 if path.exists() else default_file_mode())
+        os.replace(tmp_name, path)
+    except BaseException:
+        if os.path.exists(tmp_name):
+            os.unlink(tmp_name)
+        raise
+    return True
 
 # ========== 替换特定文件 ==========
 def restore_original_files():
     """用源目录的CommonEvents.json和Tilesets.json替换输出目录的文件"""
-    files_to_restore = ["CommonEvents.json", "Tilesets.json"]
-    
-    for file_name in files_to_restore:
+    for file_name in RESTORED_FILES:
         source_file = SOURCE_DIR / file_name
         target_file = OUTPUT_DIR / file_name
         
@@ -61,13 +174,75 @@ def restore_original_files():
             continue
             
         try:
-            shutil.copy2(source_file, target_file)
-            print(f"已恢复原始文件: {file_name}")
+            if write_if_changed(target_file, source_file.read_bytes(), stat_source=source_file):
+                print(f"已恢复原始文件: {file_name}")
+            else:
+                print(f"原始文件未变化，跳过: {file_name}")
         except Exception as e:
             print(f"恢复文件 {file_name} 时出错: {e}")
 
+# ========== 单文件写回 ==========
+def write_back_file(file_path: Path, patches: dict) -> Tuple[dict, Optional[str]]:
+    """写回单个文件，可在子进程中运行，返回 (统计, 错误信息)"""
+    stats = {"applied": 0, "skipped": 0, "mismatched": 0, "written": 0, "unchanged": 0}
+    try:
+        raw = file_path.read_bytes()
+        content = json_backend.loads(raw)
+
+        updated_content = write_back_by_pointer(content, patches, stats=stats) if patches else content
+
+        # 默认沿用原文件的格式（RPG Maker 原始数据为紧凑格式，缩进会使文件体积增大2~3倍）
+        output_file = OUTPUT_DIR / file_path.name
+        if write_if_changed(output_file, json_backend.dumps(updated_content, json_backend.output_style(raw))):
+            stats["written"] += 1
+        else:
+            stats["unchanged"] += 1
+    except Exception as e:
+        return stats, f"[错误] 写入文件 {file_path}: {e}"
+    return stats, None
+
 # ========== 主处理流程 ==========
+def restore_translations_by_manifest(jobs: int = JOBS):
+    """按清单中的 (文件, JSON Pointer) 写回，不依赖文件遍历顺序和正则筛选的一致性"""
+    translations = load_translations()
+    records = load_manifest(MANIFEST_FILE)
+    patches_by_file = group_translations_by_file(records, translations)
+    stats = {"applied": 0, "skipped": 0, "mismatched": 0, "written": 0, "unchanged": 0}
+
+    OUTPUT_DIR.mkdir(exist_ok=True)
+
+    # RESTORED_FILES 最后直接从源目录恢复，不必先写回再覆盖
+    json_files = [p for p in SOURCE_DIR.glob("*.json") if p.name not in RESTORED_FILES]
+    file_patches = [patches_by_file.pop(file_path.name, {}) for file_path in json_files]
+    # 每个文件只写自己的输出，按文件列表顺序汇总统计
+    if jobs > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            results = list(tqdm(executor.map(write_back_file, json_files, file_patches),
+                                total=len(json_files), desc="写回中"))
+    else:
+        results = (write_back_file(file_path, patches)
+                   for file_path, patches in tqdm(zip(json_files, file_patches), total=len(json_files), desc="写回中"))
+    for file_stats, error in results:
+        if error:
+            print(error)
+        for key, value in file_stats.items():
+            stats[key] += value
+
+    print(f"\n已完成写回，共写入译文 {stats['applied']} 条，跳过 image 字段 {stats['skipped']} 条，"
+          f"原文已变化 {stats['mismatched']} 条")
+    print(f"重写文件 {stats['written']} 个，内容未变化跳过 {stats['unchanged']} 个")
+    for file_name in patches_by_file:
+        print(f"警告: 清单中的文件 {file_name} 不在 {SOURCE_DIR} 中，未写回")
+
+    # 保存基线，供 transfile2json.py --diff 复用未变化字符串的译文
+    save_baseline(records, translations, load_status(len(translations)), BASELINE_FILE)
+    print(f"已保存增量翻译基线到 {BASELINE_FILE}")
+
+    # 恢复特定原始文件
+    restore_original_files()
+
 def restore_translations():
+    """按提取顺序逐条写回（旧版方式，要求遍历顺序与提取时完全一致）"""
     translations = load_translations()
     idx_ptr = [0]  # 用列表包装以支持引用传递
 
@@ -76,14 +251,13 @@ def restore_translations():
     json_files = list(SOURCE_DIR.glob("*.json"))
     for file_path in tqdm(json_files, desc="写回中"):
         try:
-            with open(file_path, "r", encoding="utf-8") as f:
-                content = json.load(f)
+            raw = file_path.read_bytes()
+            content = json_backend.loads(raw)
             
             updated_content = write_back_translations(content, translations, idx_ptr)
 
             output_file = OUTPUT_DIR / file_path.name
-            with open(output_file, "w", encoding="utf-8") as f:
-                json.dump(updated_content, f, ensure_ascii=False, indent=2)
+            write_if_changed(output_file, json_backend.dumps(updated_content, json_backend.output_style(raw)))
 
         except Exception as e:
             print(f"[错误] 写入文件 {file_path}: {e}")
@@ -97,7 +271,15 @@ def restore_translations():
 
 # ========== 启动 ==========
 def main():
-    restore_translations()
+    parser = argparse.ArgumentParser(description="将 translation_strings_cn.json 写回 www/data")
+    parser.add_argument("--jobs", type=int, default=JOBS, help="并行写回文件的进程数（默认 %(default)s，即单进程；仅清单模式）")
+    args = parser.parse_args()
+
+    if MANIFEST_FILE.exists():
+        restore_translations_by_manifest(args.jobs)
+    else:
+        print(f"未找到清单文件 {MANIFEST_FILE}，按提取顺序写回")
+        restore_translations()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file